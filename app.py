@@ -1,38 +1,42 @@
 import os
+import sys
 import platform
 import subprocess
 import shutil
+import stat
 import socket
-import ipaddress
 import threading
 import re
 import shlex
+import selectors
+import codecs
 from pathlib import Path
 import time
 from datetime import datetime
+from dataclasses import dataclass
 import webbrowser
 import signal
-from typing import Dict, Optional, Any, Tuple
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, Any, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import sqlite3
-from multiprocessing import Pool, cpu_count
 import json
 import logging
 from logging.handlers import RotatingFileHandler
 import binascii
+import mmap
+import uuid
 
 from flask import Flask, jsonify, request, send_from_directory, Response, Blueprint
 from flask_socketio import SocketIO, emit, disconnect
 
 import paramiko
 from flask_cors import CORS
-from waitress import serve
 
 # --- Importações dos Módulos de Serviço Refatorados ---
 from command_builder import COMMANDS, COMMAND_METADATA, _get_command_builder, CommandExecutionError, _parse_system_info
-from ssh_service import ssh_connect, prune_ssh_cache, _handle_ssh_exception, _execute_for_each_user, _execute_shell_command, _stream_shell_command, list_sftp_backups, _handle_cleanup_wallpaper
-from network_service import NetworkScanner, get_local_ip_and_range, is_valid_ip, check_host_online, send_wake_on_lan, send_batch_wake_on_lan, get_windows_arp_table, discover_ips_with_arp_scan, resolve_remote_hostname, IS_WSL
-from vnc_service import ensure_remote_vnc_server, stop_websockify_proxy, get_remote_screenshot
+from ssh_service import ssh_connect, _ips_in_known_hosts, _remove_known_hosts_entries, _ssh_keygen_remove, _ssh_error_categories, get_cached_ssh_client, checkout_ssh_client, release_ssh_client, prune_ssh_cache, _handle_ssh_exception, _execute_for_each_user, _execute_shell_command, _stream_shell_command, list_sftp_backups, _handle_cleanup_wallpaper
+from network_service import NetworkScanner, get_local_ip_and_range, is_valid_ip, check_host_online, send_wake_on_lan, send_batch_wake_on_lan, get_windows_arp_table, discover_ips_with_arp_scan, discover_ips_with_epoll, HOST_PROBE_PORTS, read_kernel_arp_table, invalidate_network_caches, resolve_remote_hostname, detect_os_from_ssh_banner, IS_WSL
+from vnc_service import ensure_remote_vnc_server, stop_websockify_proxy, prune_websockify_procs, get_remote_screenshot
 
 
 # --- Configuração da Aplicação Flask & SocketIO ---
@@ -95,6 +99,9 @@ def handle_exception(e):
 
 # Define o diretório raiz para servir arquivos estáticos (frontend)
 APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+# Diretório dos backups da aplicação (resolvido uma vez, usado na checagem de Path Traversal)
+APP_BACKUP_DIR = os.path.join(APP_ROOT, 'backups_app')
+_APP_BACKUP_DIR_RESOLVED = Path(APP_BACKUP_DIR).resolve()
 
 # --- Configurações de Segurança ---
 # Regex para sanitizar nomes de processos e evitar Command Injection
@@ -111,10 +118,21 @@ FORCE_STATIC_RANGE = os.getenv("FORCE_STATIC_RANGE", "false").lower() == "true"
 IP_PREFIX = os.getenv("IP_PREFIX", "192.168.50.")
 IP_START = int(os.getenv("IP_START", "1"))
 IP_END = int(os.getenv("IP_END", "254"))
-IP_EXCLUSION_LIST = os.getenv("IP_EXCLUSION_LIST", "").split(",") if os.getenv("IP_EXCLUSION_LIST") else []
+IP_EXCLUSION_LIST = frozenset(ip.strip() for ip in os.getenv("IP_EXCLUSION_LIST", "").split(",") if ip.strip())
 SSH_USER = os.getenv("SSH_USER", "aluno")
 BACKUP_ROOT_DIR = "atalhos_desativados"
 DEFAULT_PASSWORD = os.getenv("DEFAULT_PASSWORD", "qwe123")
+# Regexes compiladas uma única vez: MAC normalizado (aa:bb:..) e linha IP + MAC da saída do `arp -a`
+_MAC_ADDR_RE = re.compile(r"^([0-9a-f]{2}[:]){5}([0-9a-f]{2})$")
+_ARP_LINE_RE = re.compile(r'(\d{1,3}(?:\.\d{1,3}){3}).*?(([0-9a-fA-F]{2}[:-]){5}[0-9a-fA-F]{2})')
+# Limite de workers simultâneos na verificação de status (evita centenas de threads em salas grandes)
+STATUS_CHECK_MAX_WORKERS = int(os.getenv("STATUS_CHECK_MAX_WORKERS", "32"))
+# Workers do ping de fallback do /api/ping-check (pool próprio, separado do de status)
+PING_CHECK_MAX_WORKERS = int(os.getenv("PING_CHECK_MAX_WORKERS", "8"))
+# Prazo (s) de TCP, banner e autenticação ao abrir SSH no /check-status (o padrão do paramiko chega a 60s)
+STATUS_SSH_CONNECT_TIMEOUT = float(os.getenv("STATUS_SSH_CONNECT_TIMEOUT", "3"))
+# Cache (s) dos arquivos do noVNC no navegador: biblioteca de terceiros que só muda quando é atualizada
+NOVNC_CACHE_MAX_AGE = int(os.getenv("NOVNC_CACHE_MAX_AGE", "86400"))
 
 def get_request_password(data: Dict) -> str:
     """Extrai a senha da requisição ou retorna a senha padrão."""
@@ -122,6 +140,39 @@ def get_request_password(data: Dict) -> str:
         return DEFAULT_PASSWORD
     return data.get('password') or DEFAULT_PASSWORD
 
+@dataclass
+class ActionRequest:
+    """Campos comuns das requisições de ação SSH, extraídos e validados uma única vez."""
+    ip: Optional[str]
+    action: Optional[str]
+    password: str
+    target_user: Optional[str] = None
+
+    @classmethod
+    def from_payload(cls, data: Dict[str, Any]) -> 'ActionRequest':
+        """
+        Extrai ip/ação/senha do payload. Um IP com flag de usuário (ex: 192.168.0.10/aluno1)
+        é separado e o payload é atualizado para os construtores de comando e o ssh_service.
+        """
+        ip = data.get('ip')
+        target_user = None
+        if ip and '/' in ip:
+            ip, _, suffix = ip.partition('/')
+            ip = ip.strip()
+            target_user = suffix.strip() or None
+            if target_user:
+                data['target_user'] = target_user
+                data['ip'] = ip
+        return cls(ip=ip, action=data.get('action'), password=get_request_password(data), target_user=target_user)
+
+    def validation_error(self) -> Optional[str]:
+        """Retorna a mensagem de erro de validação, ou None se a requisição for válida."""
+        if self.ip and not is_valid_ip(self.ip):
+            return "Endereço IP inválido."
+        if not all([self.ip, self.action, self.password]):
+            return "IP, ação e senha são obrigatórios."
+        return None
+
 class DatabaseManager:
     """Gerencia a persistência em SQLite com foco em integridade e concorrência."""
     def __init__(self, root_path):
@@ -277,6 +328,8 @@ def start_scheduler():
             try:
                 # Manutenção de recursos: limpa conexões SSH mortas do pool
                 prune_ssh_cache(app.logger)
+                # Recolhe, sem espera, proxies websockify que encerraram sozinhos
+                prune_websockify_procs(app.logger)
 
                 # Formato do datetime-local do HTML: YYYY-MM-DDTHH:MM
                 now = datetime.now().strftime('%Y-%m-%dT%H:%M')
@@ -303,16 +356,25 @@ def start_scheduler():
                     else:
                         # Ações via SSH (Shutdown, Reboot, etc)
                         pwd = task_password or DEFAULT_PASSWORD
-                        for ip in ips:
-                            if not is_valid_ip(ip): continue
+
+                        def run_scheduled_action(ip):
+                            """Executa a ação em um IP e retorna (ip, resultado, erro), sem estado compartilhado."""
                             try:
                                 with ssh_connect(ip, SSH_USER, pwd, app.logger) as ssh:
-                                    # Prepara o payload para o dispatcher
-                                    payload.update({"ip": ip, "password": pwd, "action": action, "shell_action_handler": _handle_shell_action})
-                                    res = _dispatch_ssh_action(ssh, ip, action, payload, app.logger)
-                                    app.logger.info(f"[Agendador] IP {ip}: {res.get('message')}")
+                                    # Payload próprio por IP: as threads não escrevem no mesmo dicionário
+                                    ip_payload = {**payload, "ip": ip, "password": pwd, "action": action, "shell_action_handler": _handle_shell_action}
+                                    return ip, _dispatch_ssh_action(ssh, ip, action, ip_payload, app.logger), None
                             except Exception as e:
-                                app.logger.error(f"[Agendador] Falha ao executar '{action}' em {ip}: {str(e)}")
+                                return ip, None, e
+
+                        valid_ips = [ip for ip in ips if is_valid_ip(ip)]
+                        if valid_ips:
+                            with ThreadPoolExecutor(max_workers=min(STATUS_CHECK_MAX_WORKERS, len(valid_ips)), thread_name_prefix='scheduler') as executor:
+                                for ip, res, error in executor.map(run_scheduled_action, valid_ips):
+                                    if error is None:
+                                        app.logger.info(f"[Agendador] IP {ip}: {res.get('message')}")
+                                    else:
+                                        app.logger.error(f"[Agendador] Falha ao executar '{action}' em {ip}: {str(error)}")
 
                     db.mark_task_done(task_id)
             except Exception as e:
@@ -362,12 +424,25 @@ def import_macs():
         ip, mac = entry.get('ip'), entry.get('mac')
         if ip and mac and is_valid_ip(ip):
             mac_normalized = mac.replace('-', ':').lower().strip()
-            if re.match(r"^([0-9a-f]{2}[:]){5}([0-9a-f]{2})$", mac_normalized):
+            if _MAC_ADDR_RE.match(mac_normalized):
                 db.update_mac(ip, mac_normalized)
                 count += 1
     
     return jsonify({"success": True, "message": f"{count} endereços MAC importados."}) if count > 0 else (jsonify({"success": False, "message": "Dados inválidos."}), 400)
 
+# Coleta de MACs roda num único worker: descobertas seguidas não empilham uma thread
+# (e um arp-scan) por requisição; se já há uma coleta pendente, a nova é descartada.
+_HARVEST_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix='arp-harvest')
+_HARVEST_FUTURE = None
+_HARVEST_LOCK = threading.Lock()
+
+def _schedule_mac_harvest():
+    """Agenda _harvest_macs_from_arp no worker dedicado, a menos que uma coleta ainda esteja em andamento."""
+    global _HARVEST_FUTURE
+    with _HARVEST_LOCK:
+        if _HARVEST_FUTURE is None or _HARVEST_FUTURE.done():
+            _HARVEST_FUTURE = _HARVEST_POOL.submit(_harvest_macs_from_arp)
+
 def _harvest_macs_from_arp():
     """Lê a tabela ARP do sistema para atualizar o cache de MACs (via network_service)."""
     known_macs = db.get_known_macs()
@@ -381,38 +456,44 @@ def _harvest_macs_from_arp():
                 if mac and mac != "00:00:00:00:00:00" and known_macs.get(ip) != mac:
                     db.update_mac(ip, mac)
 
-        # --- 1. Varredura Proativa (Deep ARP Scan) ---
-        arp_items = discover_ips_with_arp_scan()
-        if arp_items:
-            app.logger.debug(f"Deep ARP Scan: Encontrados {len(arp_items)} dispositivos.")
-            for item in arp_items:
-                ip, mac = item['ip'], item.get('mac')
-                if mac and mac != "00:00:00:00:00:00" and known_macs.get(ip) != mac:
-                    db.update_mac(ip, mac)
-
-        # --- 2. Coleta Reativa (Fallback) ---
-        if os.path.exists('/proc/net/arp'):
-            with open('/proc/net/arp', 'r') as f:
-                next(f)
-                for line in f:
-                    parts = line.split()
-                    if len(parts) >= 4:
-                        ip, mac = parts[0], parts[3]
-                        if mac != "00:00:00:00:00:00" and mac != "ff:ff:ff:ff:ff:ff" and known_macs.get(ip) != mac:
-                            db.update_mac(ip, mac)
-
-        cmd = ['arp', '-a']
-        result = subprocess.run(cmd, capture_output=True, text=True, errors='ignore', timeout=3)
-        for line in result.stdout.splitlines():
-            match = re.search(r'(\d{1,3}(?:\.\d{1,3}){3}).*?(([0-9a-fA-F]{2}[:-]){5}[0-9a-fA-F]{2})', line)
-            if match:
-                ip, mac = match.group(1), match.group(2).replace('-', ':').lower()
-                if mac != "00:00:00:00:00:00" and known_macs.get(ip) != mac:
-                    db.update_mac(ip, mac)
+        # --- 1. Tabela de vizinhos do kernel (sem subprocesso) ---
+        # A varredura que acabou de rodar já resolveu via ARP todos os hosts ativos da sub-rede.
+        kernel_arp = read_kernel_arp_table()
+        for item in kernel_arp or []:
+            ip, mac = item['ip'], item['mac']
+            if known_macs.get(ip) != mac:
+                db.update_mac(ip, mac)
+
+        # --- 2. Varredura Proativa (Deep ARP Scan), só se o kernel não trouxe nada ---
+        if not kernel_arp:
+            arp_items = discover_ips_with_arp_scan()
+            if arp_items:
+                app.logger.debug(f"Deep ARP Scan: Encontrados {len(arp_items)} dispositivos.")
+                for item in arp_items:
+                    ip, mac = item['ip'], item.get('mac')
+                    if mac and mac != "00:00:00:00:00:00" and known_macs.get(ip) != mac:
+                        db.update_mac(ip, mac)
+
+        # --- 3. Coleta Reativa via `arp -a` (Fallback para sistemas sem /proc/net/arp) ---
+        if kernel_arp is None:
+            cmd = ['arp', '-a']
+            result = subprocess.run(cmd, capture_output=True, text=True, errors='ignore', timeout=3)
+            for line in result.stdout.splitlines():
+                match = _ARP_LINE_RE.search(line)
+                if match:
+                    ip, mac = match.group(1), match.group(2).replace('-', ':').lower()
+                    if mac != "00:00:00:00:00:00" and known_macs.get(ip) != mac:
+                        db.update_mac(ip, mac)
     except Exception as e:
         app.logger.error(f"Erro ao coletar MACs da tabela ARP: {e}", exc_info=True)
 
 
+# IPs online da última varredura completa, por faixa customizada. Refreshes automáticos (quick)
+# dentro de DISCOVERY_FULL_SCAN_TTL segundos só reconfirmam esses IPs e os MACs conhecidos da faixa.
+DISCOVERY_FULL_SCAN_TTL = float(os.getenv("DISCOVERY_FULL_SCAN_TTL", "300"))
+_DISCOVERY_CACHE: Dict[Optional[str], Tuple[float, List[str]]] = {}
+_DISCOVERY_CACHE_LOCK = threading.Lock()
+
 # --- Rota para Descobrir IPs (HTTP + Streaming via Socket.IO) ---
 @app.route('/discover-ips', methods=['POST'])
 def discover_ips():
@@ -424,6 +505,9 @@ def discover_ips():
         data = request.get_json() or {}
         custom_range = data.get('custom_range')
         sid = data.get('sid')  # Socket.IO session ID para emissão progressiva
+        if data.get('refresh_network'):
+            # O cliente pediu nova detecção de rede (ex: troca de Wi-Fi/cabo)
+            invalidate_network_caches()
         ip_prefix, _, _, server_ip, gateway_ip = get_local_ip_and_range(app.logger)
         app.logger.info(f"Iniciando varredura. Gateway: {gateway_ip}")
 
@@ -433,9 +517,8 @@ def discover_ips():
                 ip_prefix = ".".join(parts[:3]) + "."
 
         ip_blocklist = db.get_blocklist()
-        comprehensive_exclusion_list = set(IP_EXCLUSION_LIST) | ip_blocklist
-        if server_ip: comprehensive_exclusion_list.add(server_ip)
-        if gateway_ip: comprehensive_exclusion_list.add(gateway_ip)
+        comprehensive_exclusion_list = ip_blocklist | IP_EXCLUSION_LIST
+        comprehensive_exclusion_list.update(filter(None, (server_ip, gateway_ip)))
 
         # Limites numéricos para filtragem
         low_bound, high_bound = IP_START, IP_END
@@ -447,26 +530,50 @@ def discover_ips():
             except (ValueError, IndexError):
                 pass
 
-        scanner = NetworkScanner(app.logger)
-        active_ips = scanner.scan(custom_range)
+        on_host = None
+        if sid:
+            def on_host(item):
+                if item['ip'] not in comprehensive_exclusion_list:
+                    socketio.emit('ip_found', item, room=sid)
 
-        if active_ips:
-            active_ips = [item for item in active_ips if is_valid_ip(item['ip'])]
+        known_macs = db.get_known_macs()
+        cached = None
+        if data.get('quick') and not data.get('refresh_network'):
+            with _DISCOVERY_CACHE_LOCK:
+                cached = _DISCOVERY_CACHE.get(custom_range)
+            if cached and time.monotonic() - cached[0] >= DISCOVERY_FULL_SCAN_TTL:
+                cached = None
+
+        scanner = NetworkScanner(app.logger, on_host=on_host)
+        if cached:
+            # Varredura incremental: só os IPs já vistos e os MACs conhecidos da faixa
+            quick_ips = set(cached[1])
+            quick_ips.update(ip for ip in known_macs if ip.startswith(ip_prefix))
+            active_ips = scanner.rescan(list(quick_ips))
+        else:
+            active_ips = scanner.scan(custom_range)
 
-        active_ips = [item for item in active_ips if item['ip'] not in comprehensive_exclusion_list]
+        # Filtro único: validação + exclusões (set) numa só passada
+        active_ips = [item for item in active_ips
+                      if item['ip'] not in comprehensive_exclusion_list and is_valid_ip(item['ip'])]
+        if not cached and active_ips:
+            with _DISCOVERY_CACHE_LOCK:
+                _DISCOVERY_CACHE[custom_range] = (time.monotonic(), [item['ip'] for item in active_ips])
 
         # Harvest MACs em thread background (não bloqueia a resposta)
-        threading.Thread(target=_harvest_macs_from_arp, daemon=True).start()
-        known_macs = db.get_known_macs()
+        _schedule_mac_harvest()
         online_ips_set = {item['ip'] for item in active_ips}
+        # O scanner já devolve os hosts em ordem numérica; só os offline acrescentados exigem reordenar
+        added_offline = False
 
         for ip in known_macs.keys():
             if ip not in online_ips_set and ip not in comprehensive_exclusion_list:
                 if ip.startswith(ip_prefix):
                     try:
-                        last_octet = int(ip.split('.')[-1])
+                        last_octet = int(ip.rpartition('.')[2])
                         if low_bound <= last_octet <= high_bound:
                             active_ips.append({'ip': ip, 'type': 'offline'})
+                            added_offline = True
                     except ValueError:
                         continue
 
@@ -483,8 +590,8 @@ def discover_ips():
                         item['hostname'] = name
                         db.update_hostname(ip, name)
 
-        if active_ips:
-            active_ips.sort(key=lambda item: ipaddress.ip_address(item['ip']))
+        if added_offline:
+            active_ips.sort(key=lambda item: socket.inet_aton(item['ip']))
 
         return jsonify({
             "success": True,
@@ -565,7 +672,7 @@ def set_mac():
         return jsonify({"success": False, "message": "Dados inválidos."}), 400
     
     mac_normalized = mac.replace('-', ':').lower().strip()
-    if not re.match(r"^([0-9a-f]{2}[:]){5}([0-9a-f]{2})$", mac_normalized):
+    if not _MAC_ADDR_RE.match(mac_normalized):
         return jsonify({"success": False, "message": "Formato de MAC inválido (ex: AA:BB:CC:DD:EE:FF)."}), 400
 
     db.update_mac(ip, mac_normalized)
@@ -636,6 +743,8 @@ def get_metadata():
         **git_info
     })
 
+_STATUS_POOL = ThreadPoolExecutor(max_workers=STATUS_CHECK_MAX_WORKERS, thread_name_prefix='status')
+
 @app.route('/check-status', methods=['POST'])
 def check_status():
     """
@@ -653,20 +762,27 @@ def check_status():
     ips = [ip for ip in ips if is_valid_ip(ip)]
 
     statuses = {}
+    if not ips:
+        return jsonify({"success": True, "statuses": statuses})
 
-    def is_port_open(ip, port, timeout=1.0):
-        """Verifica se uma porta está aberta usando socket puro (rápido)."""
-        try:
-            with socket.create_connection((ip, port), timeout=timeout):
-                return True
-        except (socket.timeout, ConnectionRefusedError, OSError):
-            return False
+    # Se já existe uma sessão SSH ativa em cache, o host está online: pula as sondas de porta/ping.
+    # Os demais têm todas as portas (e o banner SSH) sondadas de uma vez num único selector, em vez de
+    # até sete conexões sequenciais por IP dentro de cada thread.
+    cached_clients = {ip: get_cached_ssh_client(ip, SSH_USER) for ip in ips}
+    uncached_ips = [ip for ip, client in cached_clients.items() if client is None]
+    banners: Dict[str, str] = {}
+    open_ports = discover_ips_with_epoll(uncached_ips, HOST_PROBE_PORTS, banners=banners) if uncached_ips else {}
 
     def check_single_ip(ip):
         """Função executada em uma thread para verificar um único IP."""
         try:
-            # Usa a lógica unificada que tenta SSH e depois Ping como fallback
-            host_info = check_host_online(ip)
+            cached = cached_clients.get(ip)
+            if cached:
+                banner = cached.get_transport().remote_version
+                host_info = {'type': 'ssh', 'os_type': detect_os_from_ssh_banner(banner) if banner else 'linux'}
+            else:
+                # Classifica pelas portas já sondadas (ping só como fallback)
+                host_info = check_host_online(ip, open_ports.get(ip, set()), banners.get(ip))
             if not host_info:
                 return ip, {'status': 'offline', 'user_count': 0, 'os_type': 'unknown'}
 
@@ -675,7 +791,8 @@ def check_status():
             # Se skip_ssh for True, apenas confirmamos que a porta 22 está aberta sem logar
             if host_info['type'] == 'ssh' and not skip_ssh:
                 # Usa um timeout curto para uma verificação rápida.
-                with ssh_connect(ip, SSH_USER, password, app.logger, auto_fix_key=True) as ssh:
+                with ssh_connect(ip, SSH_USER, password, app.logger, auto_fix_key=True,
+                                 connect_timeout=STATUS_SSH_CONNECT_TIMEOUT) as ssh:
                     # Comando para obter hostname remoto, lista de usuários, contagem de usuários e sinal
                     cmd = "echo '---HN---'; (cat /etc/hostname 2>/dev/null || hostname 2>/dev/null); echo '---USERS---'; who | awk '{print $1}' | sort -u | tr '\n' ',' | sed 's/,$//'; echo ''; echo '---STAT---'; who | wc -l; IFACE=$(ip route | grep default | awk '{print $5}' | head -n1); [ -d /sys/class/net/$IFACE/wireless ] && awk 'NR==3 {print int($3*100/70)}' /proc/net/wireless || echo 100"
                     stdin, stdout, stderr = ssh.exec_command(cmd, timeout=5)
@@ -730,12 +847,12 @@ def check_status():
             # Qualquer outra exceção (timeout, conexão recusada) significa offline.
             return ip, {'status': 'offline', 'user_count': 0, 'os_type': 'unknown'}
 
-    # Usa pool controlado de no máximo 20 workers para garantir alta velocidade e baixo consumo de memória
-    with ThreadPoolExecutor(max_workers=min(20, max(5, len(ips)))) as executor:
-        future_to_ip = {executor.submit(check_single_ip, ip): ip for ip in ips}
-        for future in as_completed(future_to_ip):
-            ip, status = future.result()
-            statuses[ip] = status
+    # Pool persistente compartilhado entre requisições: as threads são reaproveitadas a cada
+    # polling e o total de threads fica limitado mesmo com vários clientes consultando ao mesmo tempo.
+    future_to_ip = {_STATUS_POOL.submit(check_single_ip, ip): ip for ip in ips}
+    for future in as_completed(future_to_ip):
+        ip, status = future.result()
+        statuses[ip] = status
 
     return jsonify({"success": True, "statuses": statuses})
 # --- Rota para servir o Frontend ---
@@ -753,8 +870,10 @@ def serve_frontend(path: str):
         # Se for um arquivo estático não encontrado (ex: logo.png), retorna 404 limpo sem exceção
         if '.' in path and not path.endswith('.html'):
             return jsonify({"success": False, "message": "Arquivo não encontrado."}), 404
-        return send_from_directory(APP_ROOT, 'index.html')
-    return send_from_directory(APP_ROOT, path)
+        return send_from_directory(APP_ROOT, 'index.html', max_age=0)
+    # max_age=0 (Cache-Control: no-cache) + ETag/Last-Modified: o navegador revalida e recebe 304 sem
+    # corpo enquanto o arquivo não muda, e nunca usa uma versão antiga depois de uma atualização/restauração.
+    return send_from_directory(APP_ROOT, path, max_age=0)
 
 @app.route('/favicon.ico')
 def favicon():
@@ -819,11 +938,13 @@ def _handle_shell_action(ssh: paramiko.SSHClient, username: Optional[str], actio
             "details": warnings
         }
 
-    # Combina avisos e erros não fatais nos detalhes
-    details_list = []
-    if warnings: details_list.append(f"Avisos:\n{warnings}")
-    if errors: details_list.append(f"Erros não fatais:\n{errors}")
-    final_details = "\n\n".join(details_list) if details_list else None
+    # Combina avisos e erros não fatais nos detalhes (só monta a string quando há o que reportar)
+    final_details = None
+    if warnings or errors:
+        details_list = []
+        if warnings: details_list.append(f"Avisos:\n{warnings}")
+        if errors: details_list.append(f"Erros não fatais:\n{errors}")
+        final_details = "\n\n".join(details_list)
 
     # A operação é um sucesso mesmo com avisos.
     return {"success": True, "message": output or "Ação executada com sucesso.", "details": final_details}
@@ -847,25 +968,12 @@ def stream_action():
     Ideal para comandos de longa duração como 'atualizar_sistema'.
     """
     data = request.get_json() or {}
-    raw_ip = data.get('ip')
-    ip = raw_ip
-    
-    if raw_ip and '/' in raw_ip:
-        parts = raw_ip.split('/', 1)
-        ip = parts[0].strip()
-        target_user_suffix = parts[1].strip()
-        if target_user_suffix:
-            data['target_user'] = target_user_suffix
-            data['ip'] = ip
+    req = ActionRequest.from_payload(data)
+    ip, action, password = req.ip, req.action, req.password
 
-    action = data.get('action')
-    password = get_request_password(data)
-
-    if ip and not is_valid_ip(ip):
-        return Response("Endereço IP inválido.", status=400, mimetype='text/plain')
-
-    if not all([ip, action, password]):
-        return Response("IP, ação e senha são obrigatórios.", status=400, mimetype='text/plain')
+    error = req.validation_error()
+    if error:
+        return Response(error, status=400, mimetype='text/plain')
 
     command_builder = _get_command_builder(action)
     if not command_builder:
@@ -896,9 +1004,8 @@ def list_backups():
     """
     Conecta a um IP e lista os diretórios de backup de atalhos disponíveis.
     """
-    data = request.get_json()
-    ip = data.get('ip')
-    password = get_request_password(data)
+    req = ActionRequest.from_payload(request.get_json() or {})
+    ip, password = req.ip, req.password
 
     if not all([ip, password]):
         return jsonify({"success": False, "message": "IP e senha são obrigatórios."}), 400
@@ -948,28 +1055,13 @@ def gerenciar_atalhos_ip():
     if not data:
         return jsonify({"success": False, "message": "Requisição inválida."}), 400
 
-    # Processa o IP para verificar se há uma flag de usuário (ex: 192.168.0.10/aluno1)
-    raw_ip = data.get('ip')
-    ip = raw_ip
-    
-    if raw_ip and '/' in raw_ip:
-        parts = raw_ip.split('/', 1)
-        ip = parts[0].strip()
-        target_user_suffix = parts[1].strip()
-        # Define o target_user no payload, que será usado pelo ssh_service
-        if target_user_suffix:
-            data['target_user'] = target_user_suffix
-            # Atualiza o IP limpo no dicionário para evitar erros de conexão
-            data['ip'] = ip
-
-    action = data.get('action')
-    password = get_request_password(data)
+    # Processa o IP (incluindo a flag de usuário, ex: 192.168.0.10/aluno1) e valida os campos
+    req = ActionRequest.from_payload(data)
+    ip, action, password = req.ip, req.action, req.password
 
-    if ip and not is_valid_ip(ip):
-        return jsonify({"success": False, "message": "Endereço IP inválido."}), 400
-
-    if not all([ip, action, password]):
-        return jsonify({"success": False, "message": "IP, ação e senha são obrigatórios."}), 400
+    error = req.validation_error()
+    if error:
+        return jsonify({"success": False, "message": error}), 400
     
     # Ação de Wake-on-LAN (Ligar) - Ação local que não requer SSH
     if action == 'wake_on_lan' or action == 'ligar':
@@ -1077,62 +1169,190 @@ def batch_wake_on_lan():
         app.logger.error(f"Erro ao executar Wake-on-LAN em lote: {e}", exc_info=True)
         return jsonify({"success": False, "message": f"Erro interno: {str(e)}"}), 500
 
-@app.route('/backup-application', methods=['POST'])
-def backup_application():
+# Nível DEFLATE dos backups da aplicação: 1 é bem mais rápido que o padrão (6) e quase do mesmo tamanho para código-fonte
+BACKUP_COMPRESS_LEVEL = int(os.getenv("BACKUP_COMPRESS_LEVEL", "1"))
+# Acima deste tamanho o arquivo é lido via mmap no backup, mesmo quando comprimido
+_BACKUP_MMAP_THRESHOLD = 4 * 1024 * 1024
+# Formatos já comprimidos: recomprimir com DEFLATE só gasta CPU sem reduzir o tamanho
+_PRECOMPRESSED_EXTENSIONS = {'.zip', '.gz', '.png', '.jpg', '.jpeg', '.gif', '.ico', '.mp3', '.oga', '.woff', '.woff2', '.ttf'}
+
+def _backup_compress_type(filename: str) -> int:
+    """Escolhe ZIP_STORED para arquivos já comprimidos e ZIP_DEFLATED para o restante (texto/código)."""
+    import zipfile
+    if os.path.splitext(filename)[1].lower() in _PRECOMPRESSED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+# Entradas que nunca entram no backup; pastas excluídas são podadas sem descer nelas
+_BACKUP_EXCLUDED_NAMES = frozenset({'venv', '.venv', '.git', '__pycache__', 'backups_app', 'noVNC-master', 'novnc.zip'})
+_BACKUP_EXCLUDED_SUFFIXES = ('.pyc', '.pyo')
+
+def _iter_backup_files(directory: str):
+    """Percorre recursivamente um diretório com os.scandir, gerando (caminho, stat) de cada arquivo."""
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name in _BACKUP_EXCLUDED_NAMES or entry.name.endswith(_BACKUP_EXCLUDED_SUFFIXES):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                yield from _iter_backup_files(entry.path)
+            elif entry.is_file():
+                yield entry.path, entry.stat()
+
+def _backup_zipinfo(arcname: str, st: os.stat_result):
+    """Monta o ZipInfo a partir de um stat já obtido (equivalente a ZipInfo.from_file, sem novo stat)."""
+    import zipfile
+    date_time = time.localtime(max(st.st_mtime, 315532800))[0:6]  # O formato zip não representa datas antes de 1980
+    zinfo = zipfile.ZipInfo(arcname, date_time)
+    zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+    zinfo.file_size = st.st_size
+    return zinfo
+
+# Binário `zip` nativo (Info-ZIP), quando disponível, comprime o backup bem mais rápido que o zipfile.
+# BACKUP_NATIVE_ZIP=false força o caminho em processo (zipfile), sem subprocesso.
+BACKUP_NATIVE_ZIP = os.getenv("BACKUP_NATIVE_ZIP", "true").lower() in ("true", "1", "t")
+_ZIP_BIN = shutil.which('zip') if BACKUP_NATIVE_ZIP else None
+
+def _create_backup_with_zip_bin(archive_path: str, source_dir: str, arcnames: list) -> bool:
+    """Gera o arquivo com o `zip` nativo. Retorna False em caso de falha, para cair no zipfile."""
+    stored_suffixes = ':'.join(sorted(_PRECOMPRESSED_EXTENSIONS))
+    cmd = [_ZIP_BIN, '-q', f'-{max(0, min(BACKUP_COMPRESS_LEVEL, 9))}', '-n', stored_suffixes, archive_path, '-@']
+    try:
+        result = subprocess.run(cmd, cwd=source_dir, input='\n'.join(arcnames).encode('utf-8'),
+                                capture_output=True, timeout=120)
+    except (subprocess.TimeoutExpired, OSError) as e:
+        app.logger.warning(f"Falha ao executar o zip nativo, usando zipfile: {e}")
+        result = None
+    if result is not None and result.returncode == 0:
+        return True
+    if result is not None:
+        app.logger.warning(f"zip nativo retornou {result.returncode}, usando zipfile: {result.stderr.decode('utf-8', 'replace').strip()}")
+    if os.path.exists(archive_path):
+        os.remove(archive_path)
+    return False
+
+# Backups da aplicação rodam fora da thread da requisição; um único worker serializa os jobs.
+_BACKUP_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix='backup')
+# job_id -> (Future, instante do agendamento)
+_BACKUP_JOBS: Dict[str, Tuple[Any, float]] = {}
+_BACKUP_JOBS_LOCK = threading.Lock()
+# Jobs concluídos que ninguém consultou (página fechada no meio do backup) são descartados após este tempo
+_BACKUP_JOB_TTL = 3600.0
+
+def _evict_stale_backup_jobs_locked():
+    """Remove jobs concluídos agendados há mais de _BACKUP_JOB_TTL segundos (chamar com _BACKUP_JOBS_LOCK)."""
+    cutoff = time.monotonic() - _BACKUP_JOB_TTL
+    for job_id, (future, submitted_at) in list(_BACKUP_JOBS.items()):
+        if submitted_at < cutoff and future.done():
+            del _BACKUP_JOBS[job_id]
+
+def _create_application_backup() -> str:
     """
-    Cria um backup .zip do diretório da aplicação, excluindo arquivos desnecessários.
-    Esta é uma ação local, executada no servidor onde o backend está rodando.
+    Cria um backup .zip do diretório da aplicação e retorna o caminho do arquivo gerado.
+    Executado no pool de backup, fora do worker que atende a requisição.
     """
     # Importa a biblioteca zipfile apenas quando necessário.
     import zipfile
 
-    try:
-        # Diretório raiz do projeto.
-        source_dir = os.path.dirname(os.path.abspath(__file__))
-        
-        # Diretório onde os backups serão salvos.
-        backup_parent_dir = os.path.join(source_dir, 'backups_app')
-        os.makedirs(backup_parent_dir, exist_ok=True)
-
-        # Nome do arquivo de backup com data e hora.
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        archive_name = f'backup_app_{timestamp}.zip'
-        archive_path = os.path.join(backup_parent_dir, archive_name)
-
-        # Lista explícita de arquivos e pastas a serem incluídos no backup.
-        # Isso é mais seguro e previsível do que incluir tudo e excluir alguns.
-        files_to_backup = [
-            'index.html', 'style.css', 'script.js',
-            'app.py', 'command_builder.py', 'ssh_service.py', # Inclui os módulos Python
-            'actions.sh',
-        ]
-
-        # Cria o arquivo .zip e adiciona os arquivos/pastas.
-        with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for item in files_to_backup:
-                item_path = os.path.join(source_dir, item)
-                if os.path.exists(item_path):
-                    if os.path.isdir(item_path):
-                        # Adiciona uma pasta e todo o seu conteúdo recursivamente.
-                        for root, _, files in os.walk(item_path):
-                            for file in files:
-                                file_path = os.path.join(root, file)
-                                # O segundo argumento (arcname) define o caminho relativo dentro do zip.
-                                arcname = os.path.relpath(file_path, source_dir)
-                                zipf.write(file_path, arcname)
-                    else:
-                        # Adiciona um arquivo único.
-                        zipf.write(item_path, item)
-                else:
-                    app.logger.warning(f"Item de backup não encontrado e ignorado: {item_path}")
-        
+    # Diretório raiz do projeto.
+    source_dir = APP_ROOT
+
+    # Diretório onde os backups serão salvos.
+    backup_parent_dir = APP_BACKUP_DIR
+    os.makedirs(backup_parent_dir, exist_ok=True)
+
+    # Nome do arquivo de backup com data e hora.
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    archive_name = f'backup_app_{timestamp}.zip'
+    archive_path = os.path.join(backup_parent_dir, archive_name)
+
+    # Lista explícita de arquivos e pastas a serem incluídos no backup.
+    # Isso é mais seguro e previsível do que incluir tudo e excluir alguns.
+    files_to_backup = [
+        'index.html', 'style.css', 'script.js',
+        'app.py', 'command_builder.py', 'ssh_service.py', # Inclui os módulos Python
+        'actions.sh',
+    ]
+
+    # Enumera primeiro todos os arquivos (caminho absoluto, nome dentro do zip, stat).
+    # Um único os.stat por item decide entre pasta e arquivo e é reaproveitado no ZipInfo.
+    entries = []
+    for item in files_to_backup:
+        item_path = os.path.join(source_dir, item)
+        try:
+            st = os.stat(item_path)
+        except FileNotFoundError:
+            app.logger.warning(f"Item de backup não encontrado e ignorado: {item_path}")
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            # Adiciona uma pasta e todo o seu conteúdo recursivamente.
+            for file_path, file_st in _iter_backup_files(item_path):
+                # O arcname define o caminho relativo dentro do zip.
+                entries.append((file_path, os.path.relpath(file_path, source_dir), file_st))
+        elif stat.S_ISREG(st.st_mode):
+            entries.append((item_path, item, st))
+
+    if _ZIP_BIN and _create_backup_with_zip_bin(archive_path, source_dir, [arcname for _, arcname, _ in entries]):
         app.logger.info(f"Backup da aplicação criado com sucesso em: {archive_path}")
-        return jsonify({'success': True, 'message': 'Backup da aplicação criado com sucesso.', 'path': archive_path})
+        return archive_path
+
+    def read_entry(entry):
+        file_path, arcname, st = entry
+        zinfo = _backup_zipinfo(arcname, st)
+        with open(file_path, 'rb') as f:
+            # Arquivos gravados sem compressão (ZIP_STORED) e arquivos grandes são mapeados em memória:
+            # o conteúdo vai das páginas do kernel direto para o zip, sem cópia intermediária em bytes,
+            # e o zlib.crc32 recebe o arquivo inteiro em um único buffer contíguo.
+            if zinfo.file_size and (zinfo.file_size >= _BACKUP_MMAP_THRESHOLD
+                                    or _backup_compress_type(arcname) == zipfile.ZIP_STORED):
+                return zinfo, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return zinfo, f.read()
+
+    # Leitura em paralelo (pipeline): enquanto o zlib comprime um arquivo (liberando o GIL),
+    # os próximos já estão sendo lidos do disco. A escrita no zip continua sequencial e ordenada.
+    with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=BACKUP_COMPRESS_LEVEL) as zipf, \
+            ThreadPoolExecutor(max_workers=4, thread_name_prefix='backup-read') as reader:
+        for zinfo, content in reader.map(read_entry, entries):
+            compress_type = _backup_compress_type(zinfo.filename)
+            try:
+                zipf.writestr(zinfo, content, compress_type=compress_type, compresslevel=BACKUP_COMPRESS_LEVEL)
+            finally:
+                if isinstance(content, mmap.mmap):
+                    content.close()
 
-    except Exception as e:
+    app.logger.info(f"Backup da aplicação criado com sucesso em: {archive_path}")
+    return archive_path
+
+@app.route('/backup-application', methods=['POST'])
+def backup_application():
+    """
+    Agenda a criação de um backup .zip da aplicação e retorna imediatamente um job_id (HTTP 202).
+    O progresso é consultado em /backup-status/<job_id>.
+    """
+    job_id = uuid.uuid4().hex
+    with _BACKUP_JOBS_LOCK:
+        _evict_stale_backup_jobs_locked()
+        _BACKUP_JOBS[job_id] = (_BACKUP_POOL.submit(_create_application_backup), time.monotonic())
+    return jsonify({'success': True, 'message': 'Backup da aplicação iniciado.', 'job_id': job_id}), 202
+
+@app.route('/backup-status/<job_id>', methods=['GET'])
+def backup_status(job_id):
+    """Retorna o estado de um job de backup criado por /backup-application."""
+    with _BACKUP_JOBS_LOCK:
+        job = _BACKUP_JOBS.get(job_id)
+        if job is None:
+            return jsonify({'success': False, 'message': 'Job de backup não encontrado.'}), 404
+        future = job[0]
+        if not future.done():
+            return jsonify({'success': True, 'done': False, 'message': 'Backup em andamento.'})
+        # Job concluído: o resultado é entregue uma única vez e a entrada é descartada.
+        _BACKUP_JOBS.pop(job_id, None)
+
+    error = future.exception()
+    if error:
         # Loga o erro completo para depuração.
-        app.logger.error(f"Erro ao criar backup da aplicação com zipfile: {e}", exc_info=True)
-        return jsonify({'success': False, 'message': f'Falha ao criar o backup: {e}'}), 500
+        app.logger.error(f"Erro ao criar backup da aplicação com zipfile: {error}", exc_info=error)
+        return jsonify({'success': False, 'done': True, 'message': f'Falha ao criar o backup: {error}'}), 500
+    return jsonify({'success': True, 'done': True, 'message': 'Backup da aplicação criado com sucesso.', 'path': future.result()})
 
 @app.route('/list-application-backups', methods=['GET'])
 def list_application_backups():
@@ -1140,8 +1360,7 @@ def list_application_backups():
     Lista os arquivos de backup da aplicação (.zip) encontrados no diretório 'backups_app'.
     """
     try:
-        source_dir = os.path.dirname(os.path.abspath(__file__))
-        backup_dir = os.path.join(source_dir, 'backups_app')
+        backup_dir = APP_BACKUP_DIR
 
         if not os.path.exists(backup_dir):
             os.makedirs(backup_dir, exist_ok=True)
@@ -1151,11 +1370,13 @@ def list_application_backups():
         if not os.path.isdir(backup_dir):
             return jsonify({'success': True, 'backups': [], 'message': 'Diretório de backups da aplicação ainda não foi criado.'})
 
-        # Lista todos os arquivos .zip no diretório
-        backups = [f for f in os.listdir(backup_dir) if f.endswith('.zip')]
-        
-        # Ordena os backups do mais recente para o mais antigo com base no nome do arquivo
-        backups.sort(reverse=True)
+        # Lista todos os arquivos .zip no diretório (scandir reaproveita os dados do diretório)
+        with os.scandir(backup_dir) as it:
+            entries = [(e.name, e.stat().st_mtime) for e in it if e.name.endswith('.zip') and e.is_file()]
+
+        # Ordena os backups do mais recente para o mais antigo pela data de modificação
+        entries.sort(key=lambda entry: entry[1], reverse=True)
+        backups = [name for name, _ in entries]
 
         return jsonify({'success': True, 'backups': backups})
 
@@ -1163,12 +1384,57 @@ def list_application_backups():
         app.logger.error(f"Erro ao listar backups da aplicação: {e}", exc_info=True)
         return jsonify({'success': False, 'message': f'Falha ao listar backups: {e}'}), 500
 
+_RESTORE_COPY_BUFSIZE = 1 << 20
+
+def _extract_backup_archive(archive_path: str, dest_dir: str) -> None:
+    """
+    Extrai o backup em paralelo com buffers grandes (1 MiB), criando antes todos os diretórios
+    de destino. Cada thread abre seu próprio ZipFile, pois o handle não é thread-safe; o zlib
+    libera o GIL durante a descompressão. Todos os nomes são validados antes da escrita: se alguma
+    entrada escaparia de dest_dir (zip slip), nada é extraído e um ValueError é lançado.
+    """
+    import zipfile
+
+    dest_root = os.path.realpath(dest_dir)
+    targets = []
+    with zipfile.ZipFile(archive_path, 'r') as zipf:
+        for info in zipf.infolist():
+            target = os.path.realpath(os.path.join(dest_root, info.filename))
+            if os.path.commonpath([dest_root, target]) != dest_root:
+                raise ValueError(f"Entrada inválida no backup (fora do diretório da aplicação): {info.filename}")
+            targets.append((info, target))
+
+    # Cria todos os diretórios de uma vez antes de gravar os arquivos.
+    for directory in {target if info.is_dir() else os.path.dirname(target) for info, target in targets}:
+        os.makedirs(directory, exist_ok=True)
+
+    files = [(info, target) for info, target in targets if not info.is_dir()]
+    if not files:
+        return
+
+    def extract_chunk(chunk):
+        with zipfile.ZipFile(archive_path, 'r') as zipf:
+            for info, target in chunk:
+                with zipf.open(info) as src, open(target, 'wb', buffering=_RESTORE_COPY_BUFSIZE) as dst:
+                    shutil.copyfileobj(src, dst, length=_RESTORE_COPY_BUFSIZE)
+
+    workers = max(1, min(len(files), os.cpu_count() or 1, 8))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='restore') as pool:
+        # list() propaga para o chamador qualquer exceção ocorrida nas threads.
+        list(pool.map(extract_chunk, [files[i::workers] for i in range(workers)]))
+
+def _resolve_app_backup_path(backup_filename: str) -> Optional[Path]:
+    """Resolve o nome do backup dentro de APP_BACKUP_DIR; retorna None se escapar do diretório (Path Traversal)."""
+    backup_path = Path(APP_BACKUP_DIR, backup_filename).resolve()
+    if not backup_path.is_relative_to(_APP_BACKUP_DIR_RESOLVED):
+        return None
+    return backup_path
+
 @app.route('/restore-application-backup', methods=['POST'])
 def restore_application_backup():
     """
     Restaura a aplicação a partir de um arquivo de backup selecionado e reinicia o servidor.
     """
-    import zipfile
     data = request.get_json()
     backup_filename = data.get('backup_file')
 
@@ -1176,12 +1442,10 @@ def restore_application_backup():
         return jsonify({'success': False, 'message': 'Nome do arquivo de backup não fornecido.'}), 400
 
     try:
-        source_dir = os.path.dirname(os.path.abspath(__file__))
-        backup_dir = os.path.join(source_dir, 'backups_app')
-        backup_path = Path(backup_dir).joinpath(backup_filename).resolve()
-
+        source_dir = APP_ROOT
         # Prevenção contra Path Traversal (Igual à rota de delete)
-        if not backup_path.is_relative_to(Path(backup_dir).resolve()):
+        backup_path = _resolve_app_backup_path(backup_filename)
+        if backup_path is None:
             app.logger.warning(f"Tentativa de Path Traversal bloqueada no restauro! Arquivo: {backup_filename}")
             return jsonify({'success': False, 'message': 'Acesso negado.'}), 403
 
@@ -1190,15 +1454,22 @@ def restore_application_backup():
             return jsonify({'success': False, 'message': 'Arquivo de backup não encontrado.'}), 404
 
         # Extrai o conteúdo do backup para o diretório raiz da aplicação, sobrescrevendo arquivos existentes.
-        with zipfile.ZipFile(backup_path, 'r') as zipf:
-            zipf.extractall(path=source_dir)
+        _extract_backup_archive(str(backup_path), source_dir)
 
         app.logger.info(f"Aplicação restaurada com sucesso a partir de {backup_filename}. Reiniciando o servidor...")
 
         # Função para reiniciar o servidor após um pequeno atraso
         def do_restart():
             time.sleep(2) # Aguarda para garantir que a resposta HTTP seja enviada
-            os.kill(os.getpid(), signal.SIGINT) # Envia um sinal de interrupção para o processo principal
+            # Reexecuta o próprio processo com os mesmos argumentos: o código restaurado é carregado
+            # imediatamente, sem depender de um supervisor externo para subir o servidor de novo.
+            # Os sockets do Python não são herdáveis (PEP 446), então a porta é liberada no exec.
+            try:
+                logging.shutdown()
+                os.execv(sys.executable, [sys.executable, *sys.argv])
+            except OSError as e:
+                app.logger.error(f"Falha ao reexecutar a aplicação ({e}). Encerrando o processo.")
+                os.kill(os.getpid(), signal.SIGINT) # Envia um sinal de interrupção para o processo principal
 
         threading.Thread(target=do_restart).start()
 
@@ -1220,19 +1491,18 @@ def delete_application_backup():
         return jsonify({'success': False, 'message': 'Nome do arquivo de backup não fornecido.'}), 400
 
     try:
-        backup_dir = Path(APP_ROOT) / 'backups_app'
-        backup_path = (backup_dir / backup_filename).resolve()
-
         # Prevenção robusta contra Path Traversal
-        if not backup_path.is_relative_to(backup_dir.resolve()):
+        backup_path = _resolve_app_backup_path(backup_filename)
+        if backup_path is None:
              app.logger.warning(f"Tentativa de Path Traversal bloqueada! Arquivo: {backup_filename} | IP Origem: {request.remote_addr}")
              return jsonify({'success': False, 'message': 'Acesso negado.'}), 403
 
-        if not backup_path.exists():
+        # unlink direto: uma syscall só, sem checar a existência antes (e sem corrida entre as duas)
+        try:
+            backup_path.unlink()
+        except FileNotFoundError:
             app.logger.error(f"Tentativa de exclusão falhou: Backup '{backup_filename}' não existe.")
             return jsonify({'success': False, 'message': 'Arquivo de backup não encontrado.'}), 404
-
-        backup_path.unlink()
         app.logger.info(f"Backup da aplicação excluído com sucesso: {backup_filename}")
         return jsonify({'success': True, 'message': 'Backup excluído com sucesso.'})
 
@@ -1252,21 +1522,36 @@ def fix_ssh_keys():
     if not ips_to_fix or not isinstance(ips_to_fix, list):
         return jsonify({"success": False, "message": "Lista de IPs é obrigatória."}), 400
 
+    # Entradas que não são IPs válidos são recusadas aqui, antes de chegar ao known_hosts ou ao ssh-keygen
     results = {}
+    valid_ips = []
+    for ip in ips_to_fix:
+        if isinstance(ip, str) and is_valid_ip(ip):
+            valid_ips.append(ip)
+        else:
+            results[str(ip)] = {"success": False, "message": f"Endereço IP inválido: {ip}"}
+    ips_to_fix = valid_ips
+
+    # Caminho principal: uma única leitura e reescrita do known_hosts para todos os IPs
+    removed = _remove_known_hosts_entries(ips_to_fix) if ips_to_fix else set()
+    if removed is not None:
+        for ip in ips_to_fix:
+            results[ip] = {"success": True, "message": f"Chave de {ip} removida de known_hosts." if ip in removed
+                           else f"Nenhuma chave registrada para {ip} em known_hosts."}
+        return jsonify({"success": all(r['success'] for r in results.values()), "results": results}), 200
+
+    # Fallback (arquivo não pôde ser reescrito): ssh-keygen -R por IP, só para os que têm chave registrada
+    ips_with_keys = _ips_in_known_hosts(ips_to_fix)
+
     for ip in ips_to_fix:
+        if ips_with_keys is not None and ip not in ips_with_keys:
+            results[ip] = {"success": True, "message": f"Nenhuma chave registrada para {ip} em known_hosts."}
+            continue
         try:
-            # O comando ssh-keygen -R remove a chave do known_hosts.
-            # Não precisa de sudo, pois opera no arquivo do usuário que está rodando o backend.
-            command = ["ssh-keygen", "-R", ip]
-            # Usamos um timeout para evitar que o processo trave.
-            result = subprocess.run(command, capture_output=True, text=True, timeout=10, check=False)
-
-            if result.returncode == 0:
-                # A saída padrão de sucesso do ssh-keygen é útil.
-                results[ip] = {"success": True, "message": result.stdout.strip().replace('\n', ' ')}
-            else:
-                # A saída de erro também é importante.
-                results[ip] = {"success": False, "message": result.stderr.strip().replace('\n', ' ')}
+            # O ssh-keygen -R remove a chave do known_hosts (arquivo do usuário do backend, sem sudo).
+            # As chamadas são serializadas: cada uma reescreve o mesmo arquivo.
+            ok, message = _ssh_keygen_remove(ip)
+            results[ip] = {"success": ok, "message": message}
         except (subprocess.TimeoutExpired, FileNotFoundError, Exception) as e:
             error_message = f"Erro ao executar ssh-keygen para {ip}: {e}"
             app.logger.error(error_message)
@@ -1286,14 +1571,19 @@ def shutdown():
         app.logger.warning(f"Tentativa de desligamento não autorizada do IP: {request.remote_addr}")
         return jsonify({"success": False, "message": "Acesso negado."}), 403
 
-    def do_shutdown():
-        # Aguarda um segundo para garantir que a resposta HTTP seja enviada ao cliente.
-        time.sleep(1)
-        # Envia o sinal SIGINT para o processo atual, simulando um Ctrl+C.
-        # Isso permite que o servidor (Waitress ou Flask dev) encerre de forma limpa.
-        os.kill(os.getpid(), signal.SIGINT)
+    server = app.config.get('SERVER')
+    if server is not None:
+        # Servidor de produção: para o laço de aceitação (serve_forever) logo após esta resposta sair,
+        # sem pausa fixa nem ida e volta por sinal.
+        threading.Timer(0.1, server.shutdown).start()
+    else:
+        def do_shutdown():
+            # Servidor de desenvolvimento (socketio.run): aguarda a resposta HTTP ser enviada
+            # e envia SIGINT ao próprio processo, simulando um Ctrl+C.
+            time.sleep(1)
+            os.kill(os.getpid(), signal.SIGINT)
 
-    threading.Thread(target=do_shutdown).start()
+        threading.Thread(target=do_shutdown).start()
     return jsonify({"success": True, "message": "O servidor será encerrado em breve."})
 
 # --- Handlers para Web SSH Terminal (Flask-SocketIO + Paramiko) ---
@@ -1307,17 +1597,14 @@ def _close_web_ssh_session(sid: str):
         if sess:
             sess['active'] = False
             chan = sess.get('channel')
-            client = sess.get('client')
+            # Só o canal é fechado: a conexão SSH pertence ao pool e segue disponível para outras rotas
             if chan:
                 try:
                     chan.close()
                 except Exception:
                     pass
-            if client:
-                try:
-                    client.close()
-                except Exception:
-                    pass
+            # Devolve ao pool a conexão reservada pelo terminal (o prune e o LRU voltam a poder fechá-la)
+            release_ssh_client(sess['ip'], sess['username'])
 
 @socketio.on('connect_ssh')
 def handle_connect_ssh(data):
@@ -1338,50 +1625,58 @@ def handle_connect_ssh(data):
     emit('ssh_output', f"\r\n\x1b[33mConectando via SSH a {username}@{ip}...\x1b[0m\r\n")
 
     try:
-        ssh_client = paramiko.SSHClient()
-        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        
-        ssh_client.connect(
-            ip, 
-            username=username, 
-            password=password if password else None, 
-            timeout=15, 
-            banner_timeout=30,
-            look_for_keys=True,
-            allow_agent=True
-        )
-
-        channel = ssh_client.invoke_shell(term='xterm-256color', width=int(cols), height=int(rows))
+        # O terminal abre um canal na conexão do pool (a mesma de status, ações e VNC, como um
+        # ControlMaster do OpenSSH): sem novo handshake se o host já está conectado. A senha digitada é
+        # conferida contra a da conexão em cache, e a conexão fica reservada até _close_web_ssh_session.
+        ssh_client = checkout_ssh_client(ip, username, password, app.logger, verify_password=True)
+        try:
+            channel = ssh_client.invoke_shell(term='xterm-256color', width=int(cols), height=int(rows))
+        except Exception:
+            release_ssh_client(ip, username)
+            raise
         channel.settimeout(0.0)
 
         with _WEB_SSH_LOCK:
             _WEB_SSH_SESSIONS[sid] = {
-                'client': ssh_client,
                 'channel': channel,
+                'ip': ip,
+                'username': username,
                 'active': True
             }
 
         emit('ssh_connected', {"status": "connected", "ip": ip, "username": username})
 
         def read_output(sid_target, chan):
-            while True:
-                with _WEB_SSH_LOCK:
-                    sess = _WEB_SSH_SESSIONS.get(sid_target)
-                    if not sess or not sess.get('active'):
-                        break
-                try:
-                    if chan.recv_ready():
-                        out = chan.recv(4096)
-                        if not out:
+            # O canal paramiko é selecionável (fileno): a thread dorme até chegar saída, em vez de
+            # acordar a cada 20 ms. Tudo o que já chegou vai num único emit; o decodificador incremental
+            # não quebra caracteres UTF-8 divididos entre dois recv().
+            sel = selectors.DefaultSelector()
+            sel.register(chan, selectors.EVENT_READ)
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            try:
+                while True:
+                    with _WEB_SSH_LOCK:
+                        sess = _WEB_SSH_SESSIONS.get(sid_target)
+                        if not sess or not sess.get('active'):
                             break
-                        socketio.emit('ssh_output', out.decode('utf-8', errors='replace'), room=sid_target)
-                    elif chan.exit_status_ready():
+                    # Timeout curto só para notar o fechamento da sessão pelo lado do navegador
+                    sel.select(timeout=0.5)
+                    try:
+                        chunks = []
+                        while chan.recv_ready():
+                            out = chan.recv(32768)
+                            if not out:
+                                break
+                            chunks.append(out)
+                        if chunks:
+                            socketio.emit('ssh_output', decoder.decode(b''.join(chunks)), room=sid_target)
+                        elif chan.exit_status_ready() or chan.eof_received or chan.closed:
+                            break
+                    except Exception as ex:
+                        app.logger.debug(f"Loop SSH de leitura encerrado: {ex}")
                         break
-                    else:
-                        time.sleep(0.02)
-                except Exception as ex:
-                    app.logger.debug(f"Loop SSH de leitura encerrado: {ex}")
-                    break
+            finally:
+                sel.close()
 
             socketio.emit('ssh_output', "\r\n\x1b[33mConexão SSH encerrada.\x1b[0m\r\n", room=sid_target)
             socketio.emit('ssh_disconnected', {"status": "disconnected"}, room=sid_target)
@@ -1439,8 +1734,13 @@ def handle_socket_disconnect():
 # --- Rotas para Área de Trabalho Remota (noVNC) ---
 @app.route('/novnc/<path:filename>')
 def serve_novnc(filename):
-    """Servidor estático para a biblioteca noVNC."""
-    return send_from_directory(os.path.join(APP_ROOT, 'novnc'), filename)
+    """Servidor estático para a biblioteca noVNC (cacheada pelo navegador por NOVNC_CACHE_MAX_AGE segundos)."""
+    return send_from_directory(os.path.join(APP_ROOT, 'novnc'), filename, max_age=NOVNC_CACHE_MAX_AGE)
+
+# Limite de preparações VNC simultâneas: o grid abre todos os tiles de uma vez, e cada um faz
+# handshake SSH + setup do x11vnc; o excedente espera a vez em vez de disputar CPU/rede ao mesmo tempo.
+VNC_START_MAX_CONCURRENT = int(os.getenv("VNC_START_MAX_CONCURRENT", "8"))
+_VNC_START_SLOTS = threading.BoundedSemaphore(max(1, VNC_START_MAX_CONCURRENT))
 
 @app.route('/api/start-vnc', methods=['POST'])
 def api_start_vnc():
@@ -1448,13 +1748,18 @@ def api_start_vnc():
     data = request.json or {}
     ip = data.get('ip')
     password = data.get('password')
-    username = data.get('username', 'aluno')
+    # Sem usuário explícito, usa o mesmo SSH_USER das demais rotas: a preparação do VNC reaproveita
+    # a conexão SSH já aberta no pool (status, miniaturas) em vez de um novo handshake com outro usuário.
+    username = data.get('username') or SSH_USER
 
     if not ip:
         return jsonify({"success": False, "message": "IP da máquina alvo é obrigatório."}), 400
+    if not isinstance(ip, str) or not is_valid_ip(ip):
+        return jsonify({"success": False, "message": "Endereço IP inválido."}), 400
 
     display = data.get('display')
-    res = ensure_remote_vnc_server(ip, username, password, app.logger, target_display=display)
+    with _VNC_START_SLOTS:
+        res = ensure_remote_vnc_server(ip, username, password, app.logger, target_display=display)
     return jsonify(res)
 
 @app.route('/api/stop-vnc', methods=['POST'])
@@ -1469,13 +1774,16 @@ def api_stop_vnc():
 _THUMBNAIL_CACHE = {}
 _THUMBNAIL_LOCK = threading.Lock()
 
+# Categorias de erro SSH que indicam apenas host desligado/inacessível (logadas como info, não warning)
+_HOST_UNAVAILABLE_CATEGORIES = frozenset({"port_closed", "offline", "timeout"})
+
 @app.route('/api/thumbnail/<path:target_spec>', methods=['GET'])
 def api_thumbnail(target_spec):
     """
     Retorna uma miniatura JPEG em tempo real do host/assento remoto especificado.
     Suporta formato IP ou IP/usuario (ex: /api/thumbnail/192.168.0.101 ou /api/thumbnail/192.168.0.101/aluno1).
     """
-    now = time.time()
+    now = time.monotonic()
     with _THUMBNAIL_LOCK:
         if target_spec in _THUMBNAIL_CACHE:
             ts, cached_bytes, is_error = _THUMBNAIL_CACHE[target_spec]
@@ -1506,7 +1814,7 @@ def api_thumbnail(target_spec):
         return response
     except Exception as e:
         err_msg = str(e)
-        if "Porta 22" in err_msg or "offline" in err_msg.lower() or "timeout" in err_msg.lower():
+        if _ssh_error_categories(err_msg.lower()) & _HOST_UNAVAILABLE_CATEGORIES:
             app.logger.info(f"Host {target_spec} indisponível para thumbnail: {err_msg}")
         else:
             app.logger.warning(f"Falha ao capturar thumbnail para {target_spec}: {err_msg}")
@@ -1517,6 +1825,9 @@ def api_thumbnail(target_spec):
         return Response(f"Host indisponível para thumbnail: {err_msg}", status=503, mimetype='text/plain')
 
 
+# Pool próprio: os pings do grid não esperam na fila atrás dos handshakes SSH do /check-status
+_PING_POOL = ThreadPoolExecutor(max_workers=PING_CHECK_MAX_WORKERS, thread_name_prefix='ping')
+
 @app.route('/api/ping-check', methods=['POST'])
 def api_ping_check():
     """
@@ -1532,38 +1843,33 @@ def api_ping_check():
 
     ips = [ip for ip in ips if is_valid_ip(ip)]
 
-    def check_ip(ip):
-        ssh_open = False
-        vnc_open = False
-        try:
-            with socket.create_connection((ip, 22), timeout=1.0):
-                ssh_open = True
-        except (socket.timeout, socket.error):
-            pass
+    # Portas 22 e 5900 de todos os IPs num único selector, sem uma thread bloqueada por conexão
+    open_ports = discover_ips_with_epoll(ips, (22, 5900), timeout=1.0)
+
+    def ping_ip(ip):
+        # Fallback: tenta ICMP via ping do sistema (só para quem não respondeu na porta 22)
         try:
-            with socket.create_connection((ip, 5900), timeout=0.5):
-                vnc_open = True
-        except (socket.timeout, socket.error):
-            pass
+            result = subprocess.run(
+                ["ping", "-c", "1", "-W", "1", ip],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=2
+            )
+            return result.returncode == 0
+        except Exception:
+            return False
 
-        if ssh_open:
-            return ip, {"reachable": True, "ssh": True, "vnc": vnc_open}
+    results = {}
+    to_ping = []
+    for ip in ips:
+        ports = open_ports.get(ip, ())
+        if 22 in ports:
+            results[ip] = {"reachable": True, "ssh": True, "vnc": 5900 in ports}
         else:
-            # Fallback: tenta ICMP via ping do sistema
-            try:
-                result = subprocess.run(
-                    ["ping", "-c", "1", "-W", "1", ip],
-                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=2
-                )
-                ping_ok = result.returncode == 0
-            except Exception:
-                ping_ok = False
-            return ip, {"reachable": ping_ok, "ssh": False, "vnc": vnc_open}
+            to_ping.append(ip)
 
-    results = {}
-    with ThreadPoolExecutor(max_workers=min(20, max(1, len(ips)))) as executor:
-        for ip, status in executor.map(check_ip, ips):
-            results[ip] = status
+    if to_ping:
+        # Pool persistente em vez de criar threads a cada polling do grid
+        for ip, ping_ok in zip(to_ping, _PING_POOL.map(ping_ip, to_ping)):
+            results[ip] = {"reachable": ping_ok, "ssh": False, "vnc": 5900 in open_ports.get(ip, ())}
 
     return jsonify({"success": True, "results": results})
 
@@ -1573,20 +1879,45 @@ if __name__ == '__main__':
     # Configurações do servidor
     HOST = "0.0.0.0"
     PORT = int(os.getenv("FLASK_PORT", "8000"))
+    SERVER_LISTEN_BACKLOG = int(os.getenv("SERVER_LISTEN_BACKLOG", "1024"))
+    # Tempo máximo (s) de uma conexão sem tráfego: conexões keep-alive abandonadas (abas fechadas, Wi-Fi caído)
+    # liberam sua thread em vez de ficarem presas para sempre. Não corta o terminal Web SSH ocioso: o Socket.IO
+    # troca pings a cada 25s na mesma conexão, bem abaixo do limite. 0 desativa.
+    SERVER_IDLE_TIMEOUT = float(os.getenv("SERVER_IDLE_TIMEOUT", "300"))
 
     DEV_MODE = os.getenv("DEV_MODE", "false").lower() in ("true", "1", "t")
 
     print(f"DEBUG: DEV_MODE (env var check) is {DEV_MODE}")
-    def open_browser():
-        """Abre o navegador padrão na URL da aplicação."""
-        webbrowser.open_new(f'http://127.0.0.1:{PORT}/')
+    def _local_port_accepting() -> bool:
+        """Verifica se já há um servidor aceitando conexões na porta da aplicação."""
+        try:
+            with socket.create_connection(("127.0.0.1", PORT), timeout=0.5):
+                return True
+        except OSError:
+            return False
+
+    def open_browser_when_ready(stop: threading.Event, timeout: float = 15.0):
+        """
+        Abre o navegador padrão na URL da aplicação assim que o servidor aceitar conexões.
+        Não abre se a inicialização falhar (`stop` sinalizado) ou se a porta não subir dentro do prazo.
+        """
+        deadline = time.monotonic() + timeout
+        while not stop.is_set() and time.monotonic() < deadline:
+            if _local_port_accepting():
+                webbrowser.open_new(f'http://127.0.0.1:{PORT}/')
+                return
+            stop.wait(0.1)
 
     if DEV_MODE:
         print(f"--> Servidor de desenvolvimento iniciado em http://{HOST}:{PORT}")
         print("--> O servidor irá recarregar automaticamente após alterações no código.")
         print("--> Pressione Ctrl+C para encerrar.")
+        startup_failed = threading.Event()
         if not os.environ.get('WERKZEUG_RUN_MAIN'):
-            threading.Timer(1.5, open_browser).start()
+            # Porta já ocupada por outro processo: o bind vai falhar, então o navegador não é aberto
+            if _local_port_accepting():
+                startup_failed.set()
+            threading.Thread(target=open_browser_when_ready, args=(startup_failed,), daemon=True).start()
             start_scheduler()
         print("----------------------------------------\n")
         should_reload = False 
@@ -1595,6 +1926,7 @@ if __name__ == '__main__':
         try:
             socketio.run(app, host=HOST, port=PORT, debug=True, use_reloader=should_reload, allow_unsafe_werkzeug=True)
         except Exception as e:
+            startup_failed.set()
             print(f"ERRO CRÍTICO: socketio.run() falhou com exceção: {e}", flush=True)
     else:
         print(f"--> Servidor em execução em http://{HOST}:{PORT} (SocketIO Web SSH ativado).")
@@ -1602,8 +1934,29 @@ if __name__ == '__main__':
         start_scheduler()
         print("----------------------------------------\n")
         try:
-            socketio.run(app, host=HOST, port=PORT, debug=False, allow_unsafe_werkzeug=True)
+            # Servidor em modo threading (uma thread por conexão, sem pool fixo): streams longos do
+            # /stream-action e sessões do terminal Web SSH não bloqueiam as demais requisições.
+            # A fila de listen padrão do Werkzeug (128) é ampliada para rajadas de status/miniaturas da sala.
+            # O servidor é criado diretamente (equivalente ao socketio.run em modo threading) para que
+            # a rota /shutdown possa encerrá-lo com server.shutdown().
+            # Backlog e timeout ficam em subclasses, sem alterar as classes do Werkzeug para o processo todo.
+            from werkzeug.serving import ThreadedWSGIServer, WSGIRequestHandler
+
+            class _RequestHandler(WSGIRequestHandler):
+                timeout = SERVER_IDLE_TIMEOUT if SERVER_IDLE_TIMEOUT > 0 else None
+
+            class _Server(ThreadedWSGIServer):
+                request_queue_size = SERVER_LISTEN_BACKLOG
+
+            server = _Server(HOST, PORT, app, handler=_RequestHandler)
+            app.config['SERVER'] = server
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                server.server_close()
         except Exception as e:
-            print(f"ERRO CRÍTICO: socketio.run() falhou com exceção: {e}", flush=True)
+            print(f"ERRO CRÍTICO: servidor falhou com exceção: {e}", flush=True)
     print("DEBUG: app.py está encerrando.")
 
@@ -416,7 +416,7 @@ class VNCGridManager {
         let wsPort = 6080;
 
         try {
-            const bodyData = { ip, username: 'aluno', password: activePassword };
+            const bodyData = { ip, password: activePassword };
             if (display) bodyData.display = display;
 
             const prepRes = await fetch(`${getApiBaseUrl()}/api/start-vnc`, {
@@ -1,13 +1,19 @@
 import os
+import errno
+import functools
+import heapq
 import socket
+import selectors
+import struct
 import platform
 import subprocess
 import shutil
 import ipaddress
 import re
 import time
-from typing import List, Dict, Optional, Tuple, Any
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+from typing import List, Dict, Optional, Set, Tuple, Any, Iterable, Callable
+from concurrent.futures import ThreadPoolExecutor, wait
 
 # --- Configurações de Rede (Sincronizadas com o Ambiente) ---
 FORCE_STATIC_RANGE = os.getenv("FORCE_STATIC_RANGE", "false").lower() == "true"
@@ -17,6 +23,21 @@ IP_END = int(os.getenv("IP_END", "254"))
 IS_WSL = 'microsoft' in platform.uname().release.lower()
 SYSTEM = platform.system()
 
+# Máximo de sondas simultâneas na varredura de hosts (uma /24 completa em paralelo)
+SCAN_MAX_WORKERS = int(os.getenv("SCAN_MAX_WORKERS", "256"))
+# Tempo máximo (s) que a descoberta espera pela coleta ARP depois que a varredura principal terminou
+ARP_WAIT_TIMEOUT = float(os.getenv("ARP_WAIT_TIMEOUT", "5"))
+# Tempo máximo (s) de uma varredura nmap; ao estourar, o processo é encerrado e os hosts já lidos são mantidos
+NMAP_SCAN_TIMEOUT = float(os.getenv("NMAP_SCAN_TIMEOUT", "180"))
+# Portas usadas para detectar hosts ativos (SSH, SMB, RPC, RDP, VNC, HTTP)
+HOST_PROBE_PORTS = (22, 445, 135, 3389, 5900, 80, 8080)
+# Sockets por rodada do selector (select() do Windows aceita no máximo 512 descritores)
+_SWEEP_BATCH_SIZE = 500
+
+# Pool persistente das coletas ARP da descoberta: as threads são reaproveitadas entre varreduras
+# em vez de um pool criado e destruído a cada /discover-ips.
+_DISCOVERY_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix='discovery')
+
 _NMAP_PATH_CACHE = None
 
 def is_valid_ip(ip: str) -> bool:
@@ -27,15 +48,71 @@ def is_valid_ip(ip: str) -> bool:
     except ValueError:
         return False
 
+# Taxa mínima de pacotes/s do nmap: impede que o controle de congestionamento do -T4 desacelere a varredura na LAN
+NMAP_MIN_RATE = int(os.getenv("NMAP_MIN_RATE", "1000"))
+# Argumentos comuns do nmap: portas de detecção, sem DNS reverso e timeouts agressivos para LAN
+_NMAP_SCAN_ARGS = ("-p", "22,135,445,5900", "-n", "-T4", "--max-rtt-timeout", "250ms", "--min-parallelism", "100",
+                   "--min-hostgroup", "64", "--host-timeout", "3s",
+                   *(("--min-rate", str(NMAP_MIN_RATE)) if NMAP_MIN_RATE > 0 else ()), "-oG", "-")
+
+# Regexes compiladas uma única vez (saída do nmap -oG, `ip addr`, ping e faixas customizadas)
+_NMAP_HOST_RE = re.compile(r'Host: (\d{1,3}(?:\.\d{1,3}){3})\b')
+_NMAP_MAC_RE = re.compile(r'MAC: ((?:[0-9a-fA-F]{2}[:-]){5}[0-9a-fA-F]{2})')
+# Porta 22 aberta na lista "Ports:" do -oG (outras portas abertas não tornam o host SSH)
+_NMAP_SSH_OPEN_RE = re.compile(r'[\s,]22/open/tcp')
+_INET_ADDR_RE = re.compile(r'inet (\d+\.\d+\.\d+\.\d+)/\d+')
+_PING_TTL_RE = re.compile(r'ttl[=\s](\d+)', re.IGNORECASE)
+_NON_HEX_RE = re.compile(r'[^a-fA-F0-9]')
+_RANGE_LOCAL_RE = re.compile(r'^(\d+)\s*(?:-|a|to)\s*(\d+)$')
+_RANGE_SHORT_RE = re.compile(r'^(\d+\.\d+\.\d+\.)(\d+)\s*(?:-|a|to)\s*(\d+)$')
+_RANGE_FULL_RE = re.compile(r'^(\d+\.\d+\.\d+\.\d+)\s*(?:-|a|to)\s*(\d+\.\d+\.\d+\.\d+)$')
+
+# Cache da detecção de rede local (gateway/IP/faixa raramente mudam durante a execução do servidor)
+_NET_INFO_CACHE_TTL: float = 60.0  # segundos
+# Detecção que falhou (faixa padrão) é retentada após este prazo, e não a cada /discover-ips
+_NET_INFO_FAILURE_TTL: float = 10.0  # segundos
+_GATEWAY_CACHE: Optional[str] = None
+_GATEWAY_CACHE_TS: float = 0.0
+_LOCAL_RANGE_CACHE: Optional[tuple] = None
+_LOCAL_RANGE_CACHE_TS: float = 0.0
+
 def _get_default_gateway() -> Optional[str]:
+    """Retorna o gateway padrão, reaproveitando o último valor por até _NET_INFO_CACHE_TTL segundos."""
+    global _GATEWAY_CACHE, _GATEWAY_CACHE_TS
+    if _GATEWAY_CACHE and time.monotonic() - _GATEWAY_CACHE_TS < _NET_INFO_CACHE_TTL:
+        return _GATEWAY_CACHE
+    gateway = _detect_default_gateway()
+    if gateway:
+        _GATEWAY_CACHE, _GATEWAY_CACHE_TS = gateway, time.monotonic()
+    return gateway
+
+def _read_proc_net_route_gateway() -> Optional[str]:
+    """Lê o gateway padrão direto de /proc/net/route (sem fork/exec de 'ip route')."""
+    try:
+        with open('/proc/net/route') as f:
+            next(f)  # Cabeçalho
+            for line in f:
+                fields = line.split()
+                # Destination 00000000 = rota padrão; flag 0x2 (RTF_GATEWAY) indica que há um next hop
+                if len(fields) > 3 and fields[1] == '00000000' and int(fields[3], 16) & 0x2:
+                    # O gateway vem em hexadecimal little-endian (ex: 0100A8C0 -> 192.168.0.1)
+                    return socket.inet_ntoa(bytes.fromhex(fields[2])[::-1])
+    except (OSError, ValueError, StopIteration):
+        pass
+    return None
+
+def _detect_default_gateway() -> Optional[str]:
     try:
         if IS_WSL:
             # No WSL, tenta pegar o gateway físico do Windows
             return _get_windows_gateway_info('gateway')
             
         if SYSTEM == "Linux":
-            result = subprocess.run(['ip', 'route'], capture_output=True, text=True)
-            for line in result.stdout.splitlines():
+            gateway = _read_proc_net_route_gateway()
+            if gateway:
+                return gateway
+            result = subprocess.run(['ip', 'route'], capture_output=True)
+            for line in result.stdout.decode('ascii', 'replace').splitlines():
                 if line.startswith('default via'):
                     return line.split()[2]
         elif SYSTEM == "Windows":
@@ -45,18 +122,21 @@ def _get_default_gateway() -> Optional[str]:
 
 def run_windows_powershell(ps_code: str, timeout: float = 3.0) -> Optional[subprocess.CompletedProcess]:
     """Executa o PowerShell do Windows a partir do WSL (usando /init) ou do Windows nativo."""
+    # Força a saída em UTF-8: sem isso o PowerShell usa a code page OEM (ex: cp850), que varia com o idioma do Windows
+    ps_code = "[Console]::OutputEncoding = [System.Text.Encoding]::UTF8; " + ps_code
     if IS_WSL:
         cmd = ["/init", "/mnt/c/Windows/System32/WindowsPowerShell/v1.0/powershell.exe", "-NoProfile", "-Command", ps_code]
     else:
         cmd = ["powershell.exe", "-NoProfile", "-Command", ps_code]
     try:
-        res = subprocess.run(cmd, capture_output=True, text=True, errors='replace', timeout=timeout)
+        res = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8', errors='replace', timeout=timeout)
         return res
     except Exception:
         return None
 
+@functools.lru_cache(maxsize=1)
 def _find_nmap_path() -> Optional[str]:
-    """Localiza o binário do nmap no sistema."""
+    """Localiza o binário do nmap no sistema (resultado mantido até invalidate_network_caches)."""
     if SYSTEM == "Windows":
         path = shutil.which("nmap.exe") or shutil.which("nmap")
         if not path:
@@ -104,13 +184,43 @@ def _get_windows_all_prefixes() -> List[str]:
     except Exception: pass
     return []
 
+@functools.lru_cache(maxsize=8)
+def _ips_for_prefix(prefix: str) -> Tuple[str, ...]:
+    """Lista (imutável, memoizada) dos IPs de IP_START a IP_END para um prefixo como '192.168.0.'."""
+    return tuple(f"{prefix}{i}" for i in range(IP_START, IP_END + 1))
+
 def get_local_ip_and_range(logger) -> tuple:
+    """Retorna (prefixo, faixa nmap, IPs, IP local, gateway), reaproveitando a detecção por até _NET_INFO_CACHE_TTL segundos."""
+    global _LOCAL_RANGE_CACHE, _LOCAL_RANGE_CACHE_TS
+    if _LOCAL_RANGE_CACHE:
+        # Detecção que caiu na faixa padrão vale por menos tempo, para que uma falha transitória seja retentada logo
+        ttl = _NET_INFO_CACHE_TTL if (_LOCAL_RANGE_CACHE[3] or FORCE_STATIC_RANGE) else _NET_INFO_FAILURE_TTL
+        if time.monotonic() - _LOCAL_RANGE_CACHE_TS < ttl:
+            return _LOCAL_RANGE_CACHE
+    # A lista de IPs é uma tupla: o mesmo resultado em cache é compartilhado entre requisições sem cópias
+    _LOCAL_RANGE_CACHE, _LOCAL_RANGE_CACHE_TS = _detect_local_ip_and_range(logger), time.monotonic()
+    return _LOCAL_RANGE_CACHE
+
+def _source_ip_for(dest_ip: str) -> Optional[str]:
+    """
+    IP local que o kernel usaria para alcançar `dest_ip` (ex: o gateway). O connect() UDP só consulta
+    a tabela de rotas, sem enviar pacotes: funciona em redes sem internet e dispensa o `ip addr`.
+    """
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.connect((dest_ip, 9))
+            ip_str = sock.getsockname()[0]
+    except OSError:
+        return None
+    return ip_str if is_valid_ip(ip_str) and not ip_str.startswith('127.') else None
+
+def _detect_local_ip_and_range(logger) -> tuple:
     """Detecta dinamicamente o IP local e define a faixa de busca."""
     if FORCE_STATIC_RANGE:
         gateway_ip = _get_default_gateway()
         ip_prefix = IP_PREFIX_DEFAULT
         nmap_range = f"{ip_prefix}0/24"
-        ips_to_check = [f"{ip_prefix}{i}" for i in range(IP_START, IP_END + 1)]
+        ips_to_check = _ips_for_prefix(ip_prefix)
         return ip_prefix, nmap_range, ips_to_check, None, gateway_ip
     logger.debug("Iniciando detecção dinâmica de IP local.")
 
@@ -123,22 +233,29 @@ def get_local_ip_and_range(logger) -> tuple:
         if primary_interface_ip and is_valid_ip(primary_interface_ip) and not primary_interface_ip.startswith('127.'):
             base_ip = primary_interface_ip
             logger.debug(f"IP da interface primária detectado via gateway: {base_ip}")
-    
+
+    if gateway_ip and not base_ip:
+        base_ip = _source_ip_for(gateway_ip)
+        if base_ip:
+            logger.debug(f"IP da interface de saída para o gateway {gateway_ip}: {base_ip}")
+
     all_local_ips = []
-    try:
-        if SYSTEM == "Linux" or IS_WSL:
-            res = subprocess.run(['ip', '-4', 'addr', 'show'], capture_output=True, text=True)
-            for line in res.stdout.splitlines():
-                match = re.search(r'inet (\d+\.\d+\.\d+\.\d+)/\d+', line)
-                if match:
-                    ip_str = match.group(1)
-                    if is_valid_ip(ip_str) and not ip_str.startswith('127.'):
-                        all_local_ips.append(ip_str)
-        elif SYSTEM == "Windows":
-            host_name = socket.gethostname()
-            all_local_ips.extend(socket.gethostbyname_ex(host_name)[2])
-    except Exception as e:
-        logger.warning(f"Erro ao coletar todos os IPs locais: {e}")
+    # IP base já conhecido: não precisa listar as interfaces
+    if not base_ip:
+        try:
+            if SYSTEM == "Linux" or IS_WSL:
+                res = subprocess.run(['ip', '-4', 'addr', 'show'], capture_output=True)
+                for line in res.stdout.decode('utf-8', 'replace').splitlines():
+                    match = _INET_ADDR_RE.search(line)
+                    if match:
+                        ip_str = match.group(1)
+                        if is_valid_ip(ip_str) and not ip_str.startswith('127.'):
+                            all_local_ips.append(ip_str)
+            elif SYSTEM == "Windows":
+                host_name = socket.gethostname()
+                all_local_ips.extend(socket.gethostbyname_ex(host_name)[2])
+        except Exception as e:
+            logger.warning(f"Erro ao coletar todos os IPs locais: {e}")
 
     if gateway_ip and not base_ip:
         try:
@@ -182,17 +299,31 @@ def get_local_ip_and_range(logger) -> tuple:
         nmap_ranges = []
         for p in all_prefixes:
             nmap_ranges.append(f"{p}0/24")
-            aggregated_ips.extend([f"{p}{i}" for i in range(IP_START, IP_END + 1)])
+            aggregated_ips.extend(_ips_for_prefix(p))
             
         ip_prefix = primary_prefix
         nmap_range = " ".join(nmap_ranges)
-        ips_to_check = aggregated_ips
+        ips_to_check = tuple(aggregated_ips)
         logger.info(f"Faixas de rede detectadas: {nmap_range} (IP base: {base_ip})")
         return ip_prefix, nmap_range, ips_to_check, base_ip, gateway_ip
 
     ip_prefix = IP_PREFIX_DEFAULT
     logger.warning(f"Não foi possível detectar o IP local. Usando faixa padrão: {ip_prefix}0/24")
-    return ip_prefix, f"{ip_prefix}0/24", [f"{ip_prefix}{i}" for i in range(IP_START, IP_END + 1)], None, _get_default_gateway()
+    return ip_prefix, f"{ip_prefix}0/24", _ips_for_prefix(ip_prefix), None, _get_default_gateway()
+
+def invalidate_network_caches() -> None:
+    """Descarta os caches de rede (gateway, faixa local, tabela ARP, caminho do nmap) após uma troca de interface."""
+    global _GATEWAY_CACHE, _LOCAL_RANGE_CACHE, _NMAP_PATH_CACHE, _WIN_ARP_CACHE_TS
+    _GATEWAY_CACHE = None
+    _LOCAL_RANGE_CACHE = None
+    _NMAP_PATH_CACHE = None
+    _WIN_ARP_CACHE_TS = 0.0
+    _find_nmap_path.cache_clear()
+
+def _windows_to_wsl_path(path: str) -> str:
+    """Converte um caminho do Windows (C:\\dir\\arq.exe) para o ponto de montagem do WSL (/mnt/c/dir/arq.exe)."""
+    drive, rest = path[0].lower(), path[2:].replace('\\', '/')
+    return f"/mnt/{drive}{rest}"
 
 def _find_windows_nmap() -> str:
     global _NMAP_PATH_CACHE
@@ -229,9 +360,18 @@ def detect_os_from_ssh_banner(banner: str) -> str:
         return 'linux'
     return 'unknown'
 
+# SO_LINGER ligado com timeout 0: close() envia RST e o socket de sonda não fica em TIME_WAIT
+_LINGER_ABORT = struct.pack('ii', 1, 0)
+
+def _new_probe_socket() -> socket.socket:
+    """Cria um socket TCP para sondas curtas, que não deixa TIME_WAIT para trás ao ser fechado."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, _LINGER_ABORT)
+    return sock
+
 def probe_ssh_banner(ip: str, timeout: float = 0.25) -> Tuple[bool, Optional[str]]:
     """Tenta conectar na porta 22 e capturar o banner do SSH servidor."""
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock = _new_probe_socket()
     sock.settimeout(timeout)
     try:
         if sock.connect_ex((ip, 22)) == 0:
@@ -254,7 +394,7 @@ def probe_ssh_banner(ip: str, timeout: float = 0.25) -> Tuple[bool, Optional[str
 
 def probe_tcp_port(ip: str, port: int, timeout: float = 0.3) -> bool:
     """Verifica rapidamente se uma porta TCP específica está aberta."""
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock = _new_probe_socket()
     sock.settimeout(timeout)
     try:
         res = sock.connect_ex((ip, port))
@@ -273,10 +413,10 @@ def ping_host_get_ttl(ip: str, timeout_ms: int = 400) -> Tuple[bool, Optional[in
         is_windows = SYSTEM == 'Windows'
         timeout_sec = max(0.2, timeout_ms / 1000.0)
         cmd = ['ping', '-n' if is_windows else '-c', '1', '-W' if not is_windows else '-w', f"{timeout_sec}" if not is_windows else f"{timeout_ms}", ip]
-        res = subprocess.run(cmd, capture_output=True, text=True, timeout=2.0)
+        res = subprocess.run(cmd, capture_output=True, timeout=2.0)
         if res.returncode == 0:
-            out = res.stdout
-            ttl_match = re.search(r'ttl[=\s](\d+)', out, re.IGNORECASE)
+            out = res.stdout.decode('utf-8', 'replace')
+            ttl_match = _PING_TTL_RE.search(out)
             ttl = int(ttl_match.group(1)) if ttl_match else None
             return True, ttl
     except Exception:
@@ -326,9 +466,9 @@ def resolve_remote_hostname(ip: str, timeout: float = 0.5) -> Optional[str]:
         socket.setdefaulttimeout(orig_timeout)
 
     try:
-        res = subprocess.run(["avahi-resolve-address", ip], capture_output=True, text=True, timeout=timeout)
+        res = subprocess.run(["avahi-resolve-address", ip], capture_output=True, timeout=timeout)
         if res.returncode == 0 and res.stdout:
-            parts = res.stdout.strip().split()
+            parts = res.stdout.decode('utf-8', 'replace').strip().split()
             if len(parts) >= 2:
                 hn = parts[1].replace('.local', '').split('.')[0]
                 if hn and hn != ip:
@@ -338,99 +478,248 @@ def resolve_remote_hostname(ip: str, timeout: float = 0.5) -> Optional[str]:
 
     return None
 
-def check_host_online(ip: str) -> Optional[dict]:
-    """Verifica se um host está online via SSH (22), SMB (445), RPC (135), RDP (3389), VNC (5900), HTTP (80/8080) ou ICMP Ping."""
-    hostname = resolve_remote_hostname(ip, timeout=0.3)
+def discover_ips_with_epoll(ips: Iterable[str], ports: Iterable[int] = (22,), timeout: float = 0.25,
+                            banners: Optional[Dict[str, str]] = None) -> Dict[str, Set[int]]:
+    """
+    Sonda várias portas TCP de vários hosts com connect() não bloqueante e um único selector
+    (epoll no Linux), sem uma thread por IP. Retorna {ip: {portas abertas}}.
+    Se `banners` for passado, o banner SSH da porta 22 é lido no mesmo selector e gravado em banners[ip].
+    """
+    targets = [(ip, port) for ip in ips for port in ports]
+    open_ports: Dict[str, Set[int]] = {}
+
+    def connected(sock: socket.socket, ip: str, port: int) -> bool:
+        """Registra a porta aberta; devolve True se o socket segue aberto para ler o banner."""
+        open_ports.setdefault(ip, set()).add(port)
+        return banners is not None and port == 22
+
+    for start in range(0, len(targets), _SWEEP_BATCH_SIZE):
+        sel = selectors.DefaultSelector()
+        try:
+            connecting = 0
+            for ip, port in targets[start:start + _SWEEP_BATCH_SIZE]:
+                sock = _new_probe_socket()
+                sock.setblocking(False)
+                try:
+                    err = sock.connect_ex((ip, port))
+                except OSError:
+                    sock.close()
+                    continue
+                if err == 0:
+                    if connected(sock, ip, port):
+                        sel.register(sock, selectors.EVENT_READ, (ip, port, True))
+                    else:
+                        sock.close()
+                elif err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                    sel.register(sock, selectors.EVENT_WRITE, (ip, port, False))
+                    connecting += 1
+                else:
+                    sock.close()
+
+            # Conexões têm `timeout` para completar; a leitura de banner ganha mais `timeout` depois disso
+            connect_deadline = time.monotonic() + timeout
+            read_deadline = connect_deadline + timeout
+            while sel.get_map():
+                now = time.monotonic()
+                if connecting and now >= connect_deadline:
+                    # Sockets que não responderam dentro do prazo são tratados como porta fechada
+                    for key in list(sel.get_map().values()):
+                        if not key.data[2]:
+                            sel.unregister(key.fileobj)
+                            key.fileobj.close()
+                    connecting = 0
+                    continue
+                remaining = (connect_deadline if connecting else read_deadline) - now
+                if remaining <= 0:
+                    break
+                for key, _ in sel.select(timeout=remaining):
+                    sock = key.fileobj
+                    ip, port, reading = key.data
+                    if reading:
+                        try:
+                            data = sock.recv(1024)
+                        except OSError:
+                            data = b''
+                        if data:
+                            banners[ip] = data.decode('utf-8', errors='ignore').strip()
+                    else:
+                        connecting -= 1
+                        if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0 and connected(sock, ip, port):
+                            sel.modify(sock, selectors.EVENT_READ, (ip, port, True))
+                            continue
+                    sel.unregister(sock)
+                    sock.close()
+        finally:
+            for key in list(sel.get_map().values()):
+                key.fileobj.close()
+            sel.close()
+
+    return open_ports
+
+def check_host_online(ip: str, open_ports: Optional[Set[int]] = None, ssh_banner: Optional[str] = None) -> Optional[dict]:
+    """
+    Verifica se um host está online via SSH (22), SMB (445), RPC (135), RDP (3389), VNC (5900), HTTP (80/8080) ou ICMP Ping.
+    Se `open_ports` vier de uma varredura prévia (discover_ips_with_epoll), as sondas TCP individuais são puladas;
+    `ssh_banner`, se já lido na varredura, evita reconectar na porta 22.
+    O hostname só é resolvido depois que o host se mostra ativo, poupando DNS/avahi para IPs vazios.
+    """
+    res = _probe_host(ip, open_ports, ssh_banner)
+    if res:
+        hostname = resolve_remote_hostname(ip, timeout=0.3)
+        if hostname: res['hostname'] = hostname
+    return res
+
+def _probe_host(ip: str, open_ports: Optional[Set[int]], ssh_banner: Optional[str] = None) -> Optional[dict]:
+    """Classifica o host pelas portas abertas (ou ping); retorna None se estiver offline."""
+    def port_open(port: int, timeout: float) -> bool:
+        if open_ports is not None:
+            return port in open_ports
+        return probe_tcp_port(ip, port, timeout=timeout)
 
     # 1. Testa porta 22 (SSH)
-    is_ssh, banner = probe_ssh_banner(ip, timeout=0.25)
+    if open_ports is None:
+        is_ssh, banner = probe_ssh_banner(ip, timeout=0.25)
+    else:
+        is_ssh = 22 in open_ports
+        banner = ssh_banner or (probe_ssh_banner(ip, timeout=0.25)[1] if is_ssh else None)
     if is_ssh:
         os_type = detect_os_from_ssh_banner(banner) if banner else 'linux'
-        res = {'ip': ip, 'type': 'ssh', 'os_type': os_type if os_type != 'unknown' else 'linux', 'ssh_banner': banner}
-        if hostname: res['hostname'] = hostname
-        return res
+        return {'ip': ip, 'type': 'ssh', 'os_type': os_type if os_type != 'unknown' else 'linux', 'ssh_banner': banner}
 
     # 2. Teste de portas Windows comuns (445 SMB, 135 RPC, 3389 RDP)
-    if probe_tcp_port(ip, 445, timeout=0.15) or probe_tcp_port(ip, 135, timeout=0.15) or probe_tcp_port(ip, 3389, timeout=0.15):
-        res = {'ip': ip, 'type': 'ping', 'os_type': 'windows'}
-        if hostname: res['hostname'] = hostname
-        return res
+    if port_open(445, 0.15) or port_open(135, 0.15) or port_open(3389, 0.15):
+        return {'ip': ip, 'type': 'ping', 'os_type': 'windows'}
 
     # 3. Teste de portas VNC (5900) / Web (80)
-    if probe_tcp_port(ip, 5900, timeout=0.15) or probe_tcp_port(ip, 80, timeout=0.15) or probe_tcp_port(ip, 8080, timeout=0.15):
-        res = {'ip': ip, 'type': 'ping', 'os_type': 'linux'}
-        if hostname: res['hostname'] = hostname
-        return res
+    if port_open(5900, 0.15) or port_open(80, 0.15) or port_open(8080, 0.15):
+        return {'ip': ip, 'type': 'ping', 'os_type': 'linux'}
 
     # 4. ICMP Ping Fallback
     is_online, ttl = ping_host_get_ttl(ip, timeout_ms=300)
     if is_online:
         os_type = detect_os_fingerprint(ip, ttl=ttl)
-        res = {'ip': ip, 'type': 'ping', 'os_type': os_type if os_type != 'unknown' else 'linux'}
-        if hostname: res['hostname'] = hostname
-        return res
+        return {'ip': ip, 'type': 'ping', 'os_type': os_type if os_type != 'unknown' else 'linux'}
 
     return None
 
-def discover_ips_with_nmap(ip_range: str, logger) -> Optional[List[dict]]:
-    """Executa o nmap para descobrir hosts ativos, priorizando a versão nativa do sistema."""
+def discover_ips_with_nmap(ip_range: str, logger, on_host: Optional[Callable[[dict], None]] = None) -> Optional[List[dict]]:
+    """
+    Executa o nmap para descobrir hosts ativos, priorizando a versão nativa do sistema.
+    A saída é lida linha a linha enquanto o nmap roda; `on_host` (opcional) recebe cada host assim que ele aparece.
+    """
     nmap_path = _find_nmap_path()
+    targets = ip_range.split()
     if IS_WSL and (not nmap_path or nmap_path.endswith('.exe')):
-        nmap_exe = _find_windows_nmap()
-        ps_code = f"& {nmap_exe} -p 22,135,445,5900 -n -T4 --max-rtt-timeout 250ms --min-parallelism 100 --min-hostgroup 64 --host-timeout 3s -oG - {ip_range}"
-        command = ["/init", "/mnt/c/Windows/System32/WindowsPowerShell/v1.0/powershell.exe", "-NoProfile", "-Command", ps_code]
+        # Executa o nmap.exe diretamente pela interop do WSL, sem abrir um PowerShell a cada varredura
+        nmap_exe = _find_windows_nmap().strip('"')
+        if nmap_exe == "nmap":
+            return None
+        command = ["/init", _windows_to_wsl_path(nmap_exe), *_NMAP_SCAN_ARGS, *targets]
     elif nmap_path:
-        command = [nmap_path, "-p", "22,135,445,5900", "-n", "-T4", "--max-rtt-timeout", "250ms", "--min-parallelism", "100", "--min-hostgroup", "64", "--host-timeout", "3s", "-oG", "-", ip_range]
+        command = [nmap_path.strip('"'), *_NMAP_SCAN_ARGS, *targets]
     else:
         return None
 
     try:
         logger.debug(f"Executando Nmap com comando: {' '.join(command)}")
-        result = subprocess.run(command, capture_output=True, text=True, timeout=180, errors='replace')
-        logger.debug(f"Nmap stdout: {result.stdout}")
-        logger.debug(f"Nmap stderr: {result.stderr}")
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, errors='replace', bufsize=1)
+    except Exception as e:
+        logger.error(f"Erro ao executar Nmap: {e}", exc_info=True)
+        return None
 
+    # Garante o limite de tempo mesmo com a leitura bloqueando no pipe
+    timed_out = threading.Event()
+    def _kill_on_timeout():
+        timed_out.set()
+        proc.kill()
+    killer = threading.Timer(NMAP_SCAN_TIMEOUT, _kill_on_timeout)
+    killer.start()
+    try:
         active_hosts_data = {} # Usamos dicionário para armazenar IP -> {'type': ..., 'mac': ...}
-        for line in result.stdout.splitlines():
-            if "Host:" not in line: continue
-            
-            # Regex para extrair IP e MAC
-            match = re.search(r'Host: (\d+\.\d+\.\d+\.\d+).*?MAC: (([0-9a-fA-F]{2}[:-]){5}[0-9a-fA-F]{2})', line)
-            ip = None
-            mac = None
-            if match:
-                ip = match.group(1)
-                mac = match.group(2).replace('-', ':').lower()
-            else:
-                # Fallback para IPs sem MAC na linha (ainda precisamos do IP)
-                ip_match = re.search(r'Host: (\d+\.\d+\.\d+\.\d+)', line)
-                if ip_match:
-                    ip = ip_match.group(1)
-
-            if not ip: continue 
-
-            host_entry = active_hosts_data.get(ip, {'type': 'ping', 'mac': None})
-            if "/open/tcp" in line: host_entry['type'] = 'ssh'
+        for line in proc.stdout:
+            host_match = _NMAP_HOST_RE.match(line)
+            if not host_match: continue
+
+            ip = host_match.group(1)
+            mac_match = _NMAP_MAC_RE.search(line, host_match.end())
+            mac = mac_match.group(1).replace('-', ':').lower() if mac_match else None
+
+            is_new = ip not in active_hosts_data
+            host_entry = active_hosts_data.setdefault(ip, {'type': 'ping', 'mac': None})
+            became_ssh = host_entry['type'] != 'ssh' and _NMAP_SSH_OPEN_RE.search(line, host_match.end()) is not None
+            if became_ssh: host_entry['type'] = 'ssh'
             if mac and not host_entry['mac']: host_entry['mac'] = mac
-            
-            active_hosts_data[ip] = host_entry
-        
+
+            if on_host and (is_new or became_ssh):
+                on_host({'ip': ip, 'type': host_entry['type'], 'mac': host_entry['mac']})
+
+        proc.wait()
+        if timed_out.is_set():
+            # Os hosts já transmitidos continuam válidos; só o restante da faixa fica sem resposta
+            logger.warning(f"Nmap excedeu {NMAP_SCAN_TIMEOUT:g}s e foi encerrado; mantendo {len(active_hosts_data)} hosts já encontrados.")
+        else:
+            logger.debug(f"Nmap finalizado (código {proc.returncode}) com {len(active_hosts_data)} hosts.")
         return [{'ip': ip, 'type': data['type'], 'mac': data['mac']} for ip, data in active_hosts_data.items()]
     except Exception as e:
         logger.error(f"Erro ao executar ou parsear Nmap: {e}", exc_info=True)
         return None
+    finally:
+        killer.cancel()
+        if proc.poll() is None:
+            proc.kill()
+        proc.stdout.close()
 
 
-def discover_ips_with_arp_scan(interface: Optional[str] = None) -> Optional[List[dict]]:
-    """Varredura proativa via ARP. No WSL, isso captura apenas a rede virtual."""
+def read_kernel_arp_table() -> Optional[List[dict]]:
+    """
+    Lê a tabela de vizinhos do kernel (/proc/net/arp) sem subprocesso. Após a varredura TCP,
+    ela já contém o MAC de todo host da sub-rede que respondeu ao ARP. Retorna None fora do Linux.
+    """
+    try:
+        with open('/proc/net/arp', 'r') as f:
+            next(f, None)
+            lines = f.readlines()
+    except OSError:
+        return None
+    hosts = []
+    for line in lines:
+        parts = line.split()
+        # Flags 0x2 = entrada completa (ATF_COM); incompletas têm MAC zerado
+        if len(parts) >= 4 and int(parts[2], 16) & 0x2:
+            mac = parts[3].lower()
+            if mac not in ("00:00:00:00:00:00", "ff:ff:ff:ff:ff:ff"):
+                hosts.append({'ip': parts[0], 'mac': mac, 'type': 'ping'})
+    return hosts
+
+def discover_ips_with_arp_scan(interface: Optional[str] = None, cancel: Optional[threading.Event] = None) -> Optional[List[dict]]:
+    """
+    Varredura proativa via ARP. No WSL, isso captura apenas a rede virtual.
+    Se `cancel` for sinalizado (o chamador desistiu de esperar), o arp-scan é encerrado na hora.
+    """
     try:
         command = ["sudo", "arp-scan", "--localnet", "--numeric", "--quiet", "--retry=3", "--timeout=500"]
         if interface:
             command.extend(["-I", interface])
-            
-        result = subprocess.run(command, capture_output=True, text=True, timeout=30)
+
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                stdout, _ = proc.communicate(timeout=0.2)
+                break
+            except subprocess.TimeoutExpired:
+                if (cancel is not None and cancel.is_set()) or time.monotonic() > deadline:
+                    # SIGTERM (o sudo repassa ao arp-scan); SIGKILL só se ele não sair
+                    proc.terminate()
+                    try:
+                        proc.communicate(timeout=1)
+                    except subprocess.TimeoutExpired:
+                        proc.kill()
+                        proc.communicate()
+                    return None
+
         active_hosts = []
-        for line in result.stdout.splitlines():
+        for line in stdout.decode('utf-8', 'replace').splitlines():
             parts = line.split()
             if len(parts) >= 2 and is_valid_ip(parts[0]):
                 active_hosts.append({
@@ -476,21 +765,39 @@ def get_windows_arp_table() -> List[dict]:
     return []
 
 
+def _host_sort_key(item: dict) -> bytes:
+    """Chave de ordenação numérica para resultados {'ip': ...}: inet_aton dá 4 bytes big-endian, comparáveis direto."""
+    return socket.inet_aton(item['ip'])
+
+
 class NetworkScanner:
-    def __init__(self, logger):
+    def __init__(self, logger, on_host: Optional[Callable[[dict], None]] = None):
         self.logger = logger
+        # Callback opcional chamado a cada host encontrado (permite resultados progressivos no frontend)
+        self.on_host = on_host
 
     def _check_ssh_ports_in_parallel(self, ips: List[str]) -> List[dict]:
-        active_hosts = []
-        unique_ips = sorted(list(set(ips)), key=lambda x: ipaddress.ip_address(x))
-        # Até 64 workers: IPs/254 em ~0.25s de timeout ficam prontos em ~1-2s
-        with ThreadPoolExecutor(max_workers=min(128, max(32, len(unique_ips)))) as executor:
-            futures = {executor.submit(check_host_online, ip): ip for ip in unique_ips}
-            for future in as_completed(futures):
-                res = future.result()
-                if res:
-                    active_hosts.append(res)
-        return active_hosts
+        """Sonda os IPs e retorna os hosts online já em ordem numérica (executor.map preserva a ordem)."""
+        unique_ips = sorted(set(ips), key=socket.inet_aton)
+        if not unique_ips:
+            return []
+        # Todas as portas de todos os IPs (e os banners SSH) são sondadas de uma vez num único selector;
+        # as threads ficam só para hostname e o ping de fallback.
+        banners: Dict[str, str] = {}
+        open_ports = discover_ips_with_epoll(unique_ips, HOST_PROBE_PORTS, banners=banners)
+
+        def probe(ip: str) -> Optional[dict]:
+            res = check_host_online(ip, open_ports.get(ip, set()), banners.get(ip))
+            if res and self.on_host:
+                self.on_host(res)
+            return res
+
+        with ThreadPoolExecutor(max_workers=min(SCAN_MAX_WORKERS, len(unique_ips))) as executor:
+            return [res for res in executor.map(probe, unique_ips) if res]
+
+    def rescan(self, ips: List[str]) -> List[dict]:
+        """Reconfirma apenas os IPs informados (sem ARP nem nmap), ordenados numericamente."""
+        return self._check_ssh_ports_in_parallel(ips)
 
     def _enrich_results_with_os_type(self, results: List[dict]) -> List[dict]:
         """Retorna a lista de resultados sem chamadas adicionais de rede para fingerprint."""
@@ -509,9 +816,9 @@ class NetworkScanner:
                 for part in parts:
                     if not part: continue
                     
-                    match_local = re.match(r'^(\d+)\s*(?:-|a|to)\s*(\d+)$', part)
-                    match_short = re.match(r'^(\d+\.\d+\.\d+\.)(\d+)\s*(?:-|a|to)\s*(\d+)$', part)
-                    match_full = re.match(r'^(\d+\.\d+\.\d+\.\d+)\s*(?:-|a|to)\s*(\d+\.\d+\.\d+\.\d+)$', part)
+                    match_local = _RANGE_LOCAL_RE.match(part)
+                    match_short = _RANGE_SHORT_RE.match(part)
+                    match_full = _RANGE_FULL_RE.match(part)
 
                     if match_local:
                         start, end = int(match_local.group(1)), int(match_local.group(2))
@@ -549,50 +856,53 @@ class NetworkScanner:
                                 nmap_targets.append(part)
                                 aggregated_ips.append(part)
 
-                ips_to_check = sorted(list(set(aggregated_ips)), key=lambda x: ipaddress.ip_address(x))
+                ips_to_check = sorted(set(aggregated_ips), key=socket.inet_aton)
                 nmap_range = " ".join(nmap_targets)
                 self.logger.info(f"Scanner: Usando faixa customizada: {nmap_range}")
             except Exception as e:
                 self.logger.error(f"Erro ao processar faixa '{custom_range}': {e}. Usando detecção automática.")
 
         if FORCE_STATIC_RANGE:
-            res = self._check_ssh_ports_in_parallel(ips_to_check)
-            return sorted(res, key=lambda x: ipaddress.ip_address(x['ip']))
+            return self._check_ssh_ports_in_parallel(ips_to_check)
 
-        # Coleta ARP do Windows e ARP-scan em paralelo enquanto prepara a lista de IPs
+        # Varredura da faixa e coleta ARP (tabela do Windows + arp-scan) rodam ao mesmo tempo:
+        # a varredura não espera mais o arp-scan, que só serve para achar IPs fora da faixa.
         self.logger.info("Coletando tabela ARP e iniciando varredura paralela ultra-rápida...")
-        from concurrent.futures import ThreadPoolExecutor as TPE
-        with TPE(max_workers=2) as pool:
-            f_win_arp = pool.submit(get_windows_arp_table)
-            f_arp_scan = pool.submit(discover_ips_with_arp_scan)
-            win_arp = f_win_arp.result()
-            arp_items = f_arp_scan.result() or []
-
-        known_ips = set()
-        candidate_ips = list(ips_to_check)
-
-        for item in (win_arp or []):
-            if item['ip'] not in known_ips and is_valid_ip(item['ip']) and not item['ip'].startswith('127.'):
-                known_ips.add(item['ip'])
-                if item['ip'] not in candidate_ips:
-                    candidate_ips.append(item['ip'])
-
-        for item in arp_items:
-            if item['ip'] not in known_ips and is_valid_ip(item['ip']) and not item['ip'].startswith('127.'):
-                known_ips.add(item['ip'])
-                if item['ip'] not in candidate_ips:
-                    candidate_ips.append(item['ip'])
-
-        res = self._check_ssh_ports_in_parallel(candidate_ips)
-        if res and len(res) > 0:
-            return sorted(res, key=lambda x: ipaddress.ip_address(x['ip']))
+        arp_cancel = threading.Event()
+        arp_futures = []
+        try:
+            arp_futures = [_DISCOVERY_POOL.submit(get_windows_arp_table),
+                           _DISCOVERY_POOL.submit(discover_ips_with_arp_scan, cancel=arp_cancel)]
+            # A varredura roda na própria thread da requisição; só as coletas ARP vão para o pool
+            res = self._check_ssh_ports_in_parallel(ips_to_check)
+
+            arp_items = []
+            done, _ = wait(arp_futures, timeout=ARP_WAIT_TIMEOUT)
+            for fut in done:
+                arp_items.extend(fut.result() or [])
+        finally:
+            # Não bloqueia a resposta por um arp-scan lento: quem perdeu a corrida é cancelado
+            # e o subprocesso do arp-scan é encerrado, em vez de rodar até o próprio timeout.
+            arp_cancel.set()
+            for fut in arp_futures:
+                fut.cancel()
+
+        scanned = set(ips_to_check)
+        extra_ips = {item['ip'] for item in arp_items
+                     if item['ip'] not in scanned and is_valid_ip(item['ip']) and not item['ip'].startswith('127.')}
+        if extra_ips:
+            # Só os IPs extras do ARP quebram a ordem: cada lista já vem ordenada, basta intercalar
+            res = list(heapq.merge(res, self._check_ssh_ports_in_parallel(list(extra_ips)), key=_host_sort_key))
+
+        if res:
+            return res
 
         # Estratégia 2: Nmap (Fallback)
         self.logger.info(f"Tentando descoberta com Nmap no range {nmap_range}...")
-        nmap_results = discover_ips_with_nmap(nmap_range, self.logger)
+        nmap_results = discover_ips_with_nmap(nmap_range, self.logger, on_host=self.on_host)
         if nmap_results and len(nmap_results) > 0:
             enriched = self._enrich_results_with_os_type(nmap_results)
-            return sorted(enriched, key=lambda x: ipaddress.ip_address(x['ip']))
+            return sorted(enriched, key=_host_sort_key)
 
         return []
 
@@ -600,7 +910,7 @@ def send_wake_on_lan(mac_address: str, logger: Any = None) -> bool:
     """Envia um 'Magic Packet' para o endereço MAC especificado."""
     try:
         # Sanitiza o MAC: remove :, - e espaços
-        mac_clean = re.sub(r'[^a-fA-F0-9]', '', mac_address)
+        mac_clean = _NON_HEX_RE.sub('', mac_address)
         if len(mac_clean) != 12:
             return False
             
@@ -648,7 +958,7 @@ def send_batch_wake_on_lan(mac_list: List[str], logger: Any = None) -> Dict[str,
     valid_macs = []
     for mac in mac_list:
         if not mac: continue
-        clean = re.sub(r'[^a-fA-F0-9]', '', mac)
+        clean = _NON_HEX_RE.sub('', mac)
         if len(clean) == 12:
             valid_macs.append((mac, clean))
         else:
@@ -677,9 +987,9 @@ def send_batch_wake_on_lan(mac_list: List[str], logger: Any = None) -> Dict[str,
         )
         try:
             res = subprocess.run(["powershell.exe", "-NoProfile", "-Command", ps_cmd],
-                                 capture_output=True, text=True, timeout=10)
+                                 capture_output=True, timeout=10)
             if logger and res.stdout:
-                logger.info(f"[Batch WoL Debug] {res.stdout.strip()}")
+                logger.info(f"[Batch WoL Debug] {res.stdout.decode('utf-8', 'replace').strip()}")
             for raw_mac, _ in valid_macs:
                 results[raw_mac] = True
         except Exception as e:
@@ -1848,7 +1848,7 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     // Função para buscar e exibir os IPs
-    async function fetchAndDisplayIps() {
+    async function fetchAndDisplayIps({ quick = false } = {}) {
         console.log("[fetchAndDisplayIps] Iniciando busca e exibição de IPs.");
         
         const logo = document.querySelector('.app-logo, .logo-fallback-icon');
@@ -1917,7 +1917,8 @@ document.addEventListener('DOMContentLoaded', () => {
                 fetch(`${API_BASE_URL}/discover-ips`, {
                     method: 'POST',
                     headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({ custom_range: customRange })
+                    // quick: o backend só reconfirma os IPs da última varredura completa (se ainda recente)
+                    body: JSON.stringify({ custom_range: customRange, quick })
                 })
             ]);
             const data = await scanRes.json();
@@ -4034,7 +4035,13 @@ document.addEventListener('DOMContentLoaded', () => {
                 [ACTIONS.BACKUP_APLICACAO]: async () => {
                     logStatusMessage('Iniciando backup da aplicação...', 'details');
                     const response = await fetch(`${API_BASE_URL}/backup-application`, { method: 'POST' });
-                    const data = await response.json();
+                    let data = await response.json();
+                    // O backend cria o backup em segundo plano e devolve um job_id; consulta até concluir.
+                    while (data.success && data.job_id && !data.done) {
+                        await new Promise(resolve => setTimeout(resolve, 1000));
+                        const statusResponse = await fetch(`${API_BASE_URL}/backup-status/${data.job_id}`);
+                        data = { ...(await statusResponse.json()), job_id: data.job_id };
+                    }
                     logStatusMessage(data.success ? `Backup da aplicação criado com sucesso: ${data.path}` : `Falha ao criar backup da aplicação: ${data.message}`, data.success ? 'success' : 'error');
                     return { success: data.success, skipFurtherProcessing: true };
                 },
@@ -4367,7 +4374,7 @@ document.addEventListener('DOMContentLoaded', () => {
             stopStatusMonitor(); // Também para o monitor de status
 
             if (autoRefreshToggle.checked) {
-                autoRefreshTimer = setInterval(fetchAndDisplayIps, AUTO_REFRESH_INTERVAL);
+                autoRefreshTimer = setInterval(() => fetchAndDisplayIps({ quick: true }), AUTO_REFRESH_INTERVAL);
                 startStatusMonitor(); // Inicia o monitor de status junto
                 logStatusMessage(`Atualização automática ativada (a cada ${AUTO_REFRESH_INTERVAL / 60000} minutos).`, 'details');
             } else {
@@ -4780,7 +4787,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
             let wsPort = 6080;
             try {
-                const bodyData = { ip, username: 'aluno', password: activePassword };
+                const bodyData = { ip, password: activePassword };
                 if (display) bodyData.display = display;
 
                 const prepRes = await fetch(`${API_BASE_URL}/api/start-vnc`, {
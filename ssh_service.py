@@ -1,13 +1,21 @@
 # services/ssh_service.py
 
+import os
 import posixpath
+import shutil
 import subprocess
 import stat
 import socket
+import ipaddress
 import re
 import shlex
+import selectors
 import base64
+import codecs
 import binascii
+import hashlib
+import hmac
+import tempfile
 import logging
 import paramiko
 import threading
@@ -16,44 +24,240 @@ from contextlib import contextmanager, ExitStack
 import time
 from typing import List, Dict, Tuple, Optional, Any, Generator
 
-from command_builder import CommandExecutionError
+from command_builder import CommandExecutionError, _get_command_builder
 
 logger = logging.getLogger(__name__)
 
 _SSH_CACHE: Dict[str, paramiko.SSHClient] = {}
+_SSH_LAST_USED: Dict[str, float] = {}
+# Quantos blocos `ssh_connect` estão usando cada conexão agora: o prune e o LRU não fecham conexões em uso
+_SSH_IN_USE: Dict[str, int] = {}
+# Como cada conexão do cache autenticou: None = chave/agente; bytes = HMAC da senha usada (com chave aleatória
+# do processo, a senha em si não fica na memória). Permite conferir a senha de um terminal sem novo handshake.
+_SSH_PASSWORD_DIGESTS: Dict[str, Optional[bytes]] = {}
+_PASSWORD_DIGEST_KEY = os.urandom(32)
 _CACHE_LOCK = threading.Lock()
+# Locks por "usuario@ip" para serializar a abertura de conexões ao mesmo host
+_CONNECT_LOCKS: Dict[str, threading.Lock] = {}
+# Conexões sem uso por mais que isso (segundos) são fechadas pelo prune periódico
+SSH_CACHE_MAX_IDLE = float(os.getenv("SSH_CACHE_MAX_IDLE", "60"))
+# Máximo de conexões no cache: cada transporte paramiko mantém uma thread própria, então o cache
+# limita também o número de threads. Ao exceder, a menos usada recentemente (ociosa há 10s+) é fechada.
+SSH_CACHE_MAX_SIZE = int(os.getenv("SSH_CACHE_MAX_SIZE", "128"))
+_SSH_EVICT_MIN_IDLE = 10.0
+# Intervalo (segundos) dos keepalives enviados nas conexões em cache; 0 desativa
+SSH_KEEPALIVE_INTERVAL = int(os.getenv("SSH_KEEPALIVE_INTERVAL", "15"))
 
 def prune_ssh_cache(logger):
-    """Fecha e remove conexões SSH inativas do cache global para liberar recursos."""
+    """Fecha e remove do cache global conexões SSH mortas ou ociosas há mais de SSH_CACHE_MAX_IDLE segundos."""
+    now = time.monotonic()
     with _CACHE_LOCK:
         dead_keys = []
         for key, client in _SSH_CACHE.items():
             transport = client.get_transport()
             if transport is None or not transport.is_active():
                 dead_keys.append(key)
+            elif not _SSH_IN_USE.get(key) and now - _SSH_LAST_USED.get(key, now) > SSH_CACHE_MAX_IDLE:
+                dead_keys.append(key)
         
         for key in dead_keys:
             logger.debug(f"Limpando conexão inativa do cache: {key}")
             client = _SSH_CACHE.pop(key)
+            _SSH_LAST_USED.pop(key, None)
+            _SSH_PASSWORD_DIGESTS.pop(key, None)
             try:
                 client.close()
             except Exception: pass
 
+def _evict_lru_ssh_clients_locked() -> List[paramiko.SSHClient]:
+    """
+    Remove do cache as conexões menos usadas até respeitar SSH_CACHE_MAX_SIZE (chamar com _CACHE_LOCK).
+    Só conexões fora de uso e ociosas há _SSH_EVICT_MIN_IDLE segundos saem. Retorna as removidas.
+    """
+    excess = len(_SSH_CACHE) - SSH_CACHE_MAX_SIZE
+    if SSH_CACHE_MAX_SIZE <= 0 or excess <= 0:
+        return []
+    now = time.monotonic()
+    idle = sorted((_SSH_LAST_USED.get(key, 0.0), key) for key in _SSH_CACHE
+                  if not _SSH_IN_USE.get(key) and now - _SSH_LAST_USED.get(key, 0.0) >= _SSH_EVICT_MIN_IDLE)
+    evicted = []
+    for _, key in idle[:excess]:
+        evicted.append(_SSH_CACHE.pop(key))
+        _SSH_LAST_USED.pop(key, None)
+        _SSH_PASSWORD_DIGESTS.pop(key, None)
+    return evicted
+
+def get_cached_ssh_client(ip: str, username: str) -> Optional[paramiko.SSHClient]:
+    """Retorna o cliente SSH em cache para username@ip se o transporte ainda estiver ativo (sem novo handshake)."""
+    cache_key = f"{username}@{ip}"
+    with _CACHE_LOCK:
+        client = _SSH_CACHE.get(cache_key)
+        if client is None:
+            return None
+        transport = client.get_transport()
+        if transport and transport.is_active():
+            _SSH_LAST_USED[cache_key] = time.monotonic()
+            return client
+    return None
+
+# Serializa as reescritas do known_hosts (reescrita direta e ssh-keygen -R): correções automáticas
+# disparadas por várias threads de status ao mesmo tempo não sobrescrevem a remoção umas das outras.
+_KNOWN_HOSTS_LOCK = threading.Lock()
+
+def _ssh_keygen_remove(ip: str) -> Tuple[bool, str]:
+    """Executa `ssh-keygen -R <ip>` (sob _KNOWN_HOSTS_LOCK) e retorna (sucesso, mensagem do ssh-keygen)."""
+    with _KNOWN_HOSTS_LOCK:
+        result = subprocess.run(["ssh-keygen", "-R", ip], capture_output=True, timeout=10, check=False)
+    if result.returncode == 0:
+        return True, result.stdout.decode('utf-8', 'replace').strip().replace('\n', ' ')
+    return False, result.stderr.decode('utf-8', 'replace').strip().replace('\n', ' ')
+
 def _fix_host_key(ip: str, logger) -> bool:
-    """Executa 'ssh-keygen -R <ip>' para remover uma chave de host antiga."""
+    """Remove a chave de host antiga de <ip> do known_hosts (ssh-keygen -R se a reescrita direta falhar)."""
+    removed = _remove_known_hosts_entries([ip])
+    if removed is not None:
+        logger.info(f"Chave SSH para {ip} removida automaticamente com sucesso.")
+        return True
     try:
-        command = ["ssh-keygen", "-R", ip]
-        result = subprocess.run(command, capture_output=True, text=True, timeout=10, check=False)
-        if result.returncode == 0:
+        ok, message = _ssh_keygen_remove(ip)
+        if ok:
             logger.info(f"Chave SSH para {ip} removida automaticamente com sucesso.")
             return True
         else:
-            logger.error(f"Falha ao remover automaticamente a chave SSH para {ip}: {result.stderr.strip()}")
+            logger.error(f"Falha ao remover automaticamente a chave SSH para {ip}: {message}")
             return False
     except (subprocess.TimeoutExpired, FileNotFoundError, Exception) as e:
         logger.error(f"Exceção ao tentar remover a chave SSH para {ip}: {e}")
         return False
 
+def _ips_in_known_hosts(ips: List[str]) -> Optional[set]:
+    """
+    Lê o known_hosts uma única vez e retorna os IPs que possuem chave registrada
+    (entradas com hash inclusive). Retorna None se o arquivo não puder ser interpretado.
+    """
+    path = os.path.expanduser("~/.ssh/known_hosts")
+    if not os.path.exists(path):
+        return set()
+    try:
+        host_keys = paramiko.HostKeys(path)
+    except Exception as e:
+        logger.warning(f"Não foi possível ler {path}: {e}")
+        return None
+    return {ip for ip in ips if host_keys.lookup(ip)}
+
+def _known_hosts_line_matches(host_field: str, targets: set) -> Optional[str]:
+    """Retorna o IP de `targets` coberto pelo campo de hosts de uma linha do known_hosts (com hash inclusive)."""
+    for pattern in host_field.split(','):
+        if pattern.startswith('|1|'):
+            # Entrada com hash (HashKnownHosts): |1|salt|HMAC-SHA1(salt, host), ambos em base64
+            try:
+                _, _, salt_b64, hash_b64 = pattern.split('|', 3)
+                salt, expected = base64.b64decode(salt_b64), base64.b64decode(hash_b64)
+            except (ValueError, binascii.Error):
+                continue
+            for ip in targets:
+                if hmac.compare_digest(hmac.new(salt, ip.encode(), hashlib.sha1).digest(), expected):
+                    return ip
+        elif pattern in targets:
+            return pattern
+    return None
+
+def _remove_known_hosts_entries(ips: List[str]) -> Optional[set]:
+    """
+    Remove do known_hosts, numa única leitura e escrita, as linhas dos IPs informados (equivale a um
+    `ssh-keygen -R` por IP, sem um processo e uma reescrita do arquivo para cada um). Como o ssh-keygen,
+    guarda a versão anterior em known_hosts.old. Retorna os IPs removidos, ou None se o arquivo não
+    puder ser reescrito (o chamador pode recorrer ao ssh-keygen).
+    """
+    with _KNOWN_HOSTS_LOCK:
+        return _remove_known_hosts_entries_locked(ips)
+
+def _remove_known_hosts_entries_locked(ips: List[str]) -> Optional[set]:
+    """Leitura, filtragem e reescrita do known_hosts de _remove_known_hosts_entries (chamar com _KNOWN_HOSTS_LOCK)."""
+    path = os.path.expanduser("~/.ssh/known_hosts")
+    targets = set(ips)
+    try:
+        with open(path, 'r', encoding='utf-8', errors='surrogateescape') as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return set()
+    except OSError as e:
+        logger.warning(f"Não foi possível ler {path}: {e}")
+        return None
+
+    removed = set()
+    kept = []
+    for line in lines:
+        fields = line.split()
+        # Comentários, linhas vazias e marcadores (@cert-authority/@revoked) são mantidos como estão
+        match = None
+        if fields and not fields[0].startswith(('#', '@')):
+            match = _known_hosts_line_matches(fields[0], targets)
+        if match:
+            removed.add(match)
+        else:
+            kept.append(line)
+    if not removed:
+        return removed
+
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.known_hosts.')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8', errors='surrogateescape') as f:
+                f.writelines(kept)
+            os.chmod(tmp_path, mode)
+            shutil.copy2(path, path + '.old')
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except OSError as e:
+        logger.warning(f"Não foi possível reescrever {path}: {e}")
+        return None
+    return removed
+
+# Endereços resolvidos de hosts informados por nome: "host" -> (endereço, instante da resolução)
+_HOST_ADDR_CACHE: Dict[str, Tuple[str, float]] = {}
+_HOST_ADDR_CACHE_TTL = float(os.getenv("SSH_DNS_CACHE_TTL", "300"))
+
+def _resolve_ssh_host(host: str) -> str:
+    """
+    Resolve o host para um endereço literal uma única vez (cache com TTL), evitando um getaddrinfo
+    por tentativa de conexão. IPs literais (o caso comum na LAN) retornam direto, sem consulta.
+    """
+    try:
+        ipaddress.ip_address(host)
+        return host
+    except ValueError:
+        pass
+    now = time.monotonic()
+    cached = _HOST_ADDR_CACHE.get(host)
+    if cached and now - cached[1] < _HOST_ADDR_CACHE_TTL:
+        return cached[0]
+    try:
+        addr = socket.getaddrinfo(host, 22, type=socket.SOCK_STREAM)[0][4][0]
+    except (socket.gaierror, IndexError):
+        return host
+    _HOST_ADDR_CACHE[host] = (addr, now)
+    return addr
+
+def _connect_resolved(ssh: paramiko.SSHClient, ip: str, addr: str, timeout: float, **kwargs):
+    """
+    ssh.connect para `ip` usando o endereço já resolvido. Com um nome de host, a conexão TCP é aberta
+    aqui e entregue ao paramiko (sock=), que continua indexando o known_hosts pelo nome original
+    (como o HostKeyAlias do OpenSSH).
+    """
+    if addr == ip:
+        ssh.connect(ip, timeout=timeout, **kwargs)
+        return
+    sock = socket.create_connection((addr, 22), timeout=timeout)
+    try:
+        ssh.connect(ip, sock=sock, timeout=timeout, **kwargs)
+    except BaseException:
+        sock.close()
+        raise
+
 def _is_port_open(ip: str, port: int, timeout: float = 2.0) -> bool:
     """Verifica se a porta está aberta antes de tentar conexão SSH completa."""
     try:
@@ -62,113 +266,246 @@ def _is_port_open(ip: str, port: int, timeout: float = 2.0) -> bool:
     except (socket.timeout, socket.error):
         return False
 
-@contextmanager
-def ssh_connect(ip: str, username: str, password: str, logger, auto_fix_key: bool = True) -> Generator[paramiko.SSHClient, None, None]:
+# Frases conhecidas nas mensagens de erro do paramiko/socket, mapeadas para uma categoria.
+# Compiladas em uma única alternância: a mensagem é varrida uma só vez, em vez de um `in` por frase.
+_SSH_ERROR_PHRASES = {
+    "authentication failed": "auth",
+    "inacessível": "port_closed",
+    "offline": "offline",
+    "connection timed out": "timeout",
+    "timed out": "timeout",
+    "timeout": "timeout",
+    "unable to connect": "refused",
+    "connection refused": "refused",
+    "host key for server": "host_key",
+    "does not match": "mismatch",
+    "error reading ssh protocol banner": "banner",
+    "server not found in known_hosts": "unknown_host",
+}
+_SSH_ERROR_RE = re.compile("|".join(re.escape(p) for p in sorted(_SSH_ERROR_PHRASES, key=len, reverse=True)))
+
+def _ssh_error_categories(error_str: str) -> set:
+    """Retorna as categorias de erro encontradas na mensagem (já em minúsculas)."""
+    return {_SSH_ERROR_PHRASES[m.group(0)] for m in _SSH_ERROR_RE.finditer(error_str)}
+
+def _password_digest(password: Optional[str]) -> bytes:
+    """HMAC-SHA256 da senha com a chave do processo (comparável sem guardar a senha)."""
+    return hmac.new(_PASSWORD_DIGEST_KEY, (password or "").encode(), hashlib.sha256).digest()
+
+def _verify_ssh_password(ip: str, username: str, password: str, logger):
+    """Autentica username@ip só com a senha numa conexão avulsa (fechada em seguida); levanta a exceção do paramiko se falhar."""
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    try:
+        logger.debug(f"Conferindo a senha de {username}@{ip} numa conexão avulsa")
+        _connect_resolved(ssh, ip, _resolve_ssh_host(ip), username=username, password=password,
+                          look_for_keys=False, allow_agent=False, timeout=15, banner_timeout=30)
+    finally:
+        ssh.close()
+
+def checkout_ssh_client(ip: str, username: str, password: str, logger, auto_fix_key: bool = True,
+                        connect_timeout: Optional[float] = None, verify_password: bool = False) -> paramiko.SSHClient:
     """
-    Gerencia uma conexão SSH com tratamento de exceções e fechamento automático.
-    Implementa pooling de conexões: se a conexão estiver no cache e ativa, ela é reutilizada.
+    Retorna a conexão do pool para username@ip (abrindo-a se preciso) e a marca como em uso: o prune e o LRU
+    não a fecham até release_ssh_client(ip, username). Com `verify_password`, uma conexão em cache que
+    autenticou por senha só é reaproveitada se a senha informada for a mesma (ou se autenticar de novo);
+    uma que autenticou por chave é reaproveitada direto, como uma conexão nova também entraria pela chave.
     """
     cache_key = f"{username}@{ip}"
-    cached_client = None
-    
     with _CACHE_LOCK:
+        _SSH_IN_USE[cache_key] = _SSH_IN_USE.get(cache_key, 0) + 1
+    try:
+        ssh = get_cached_ssh_client(ip, username)
+        if ssh is None:
+            # Só uma thread por host abre a conexão; as demais esperam e reutilizam a que entrou no cache.
+            with _host_connect_lock(cache_key):
+                ssh = get_cached_ssh_client(ip, username)
+                if ssh is None:
+                    return _open_ssh_client(ip, username, password, logger, auto_fix_key, connect_timeout)
+            logger.debug(f"Reutilizando conexão SSH aberta por outra requisição para {cache_key}")
+        else:
+            logger.debug(f"Reutilizando conexão SSH do cache para {cache_key}")
+
+        if verify_password:
+            digest = _password_digest(password)
+            with _CACHE_LOCK:
+                expected = _SSH_PASSWORD_DIGESTS.get(cache_key)
+            if expected is not None and not hmac.compare_digest(expected, digest):
+                # Senha diferente da usada pela conexão em cache (errada ou trocada no host): confere de novo
+                _verify_ssh_password(ip, username, password, logger)
+                with _CACHE_LOCK:
+                    if cache_key in _SSH_CACHE:
+                        _SSH_PASSWORD_DIGESTS[cache_key] = digest
+        return ssh
+    except BaseException:
+        _release_ssh_client(cache_key)
+        raise
+
+def release_ssh_client(ip: str, username: str):
+    """Devolve ao pool uma conexão obtida com checkout_ssh_client."""
+    _release_ssh_client(f"{username}@{ip}")
+
+def _release_ssh_client(cache_key: str):
+    """Marca o fim de um uso da conexão: a ociosidade passa a contar a partir daqui, não do início do uso."""
+    with _CACHE_LOCK:
+        remaining = _SSH_IN_USE.get(cache_key, 0) - 1
+        if remaining > 0:
+            _SSH_IN_USE[cache_key] = remaining
+        else:
+            _SSH_IN_USE.pop(cache_key, None)
         if cache_key in _SSH_CACHE:
-            client = _SSH_CACHE[cache_key]
-            transport = client.get_transport()
-            if transport and transport.is_active():
-                cached_client = client
-    
-    if cached_client:
-        logger.debug(f"Reutilizando conexão SSH do cache para {cache_key}")
-        yield cached_client
-        return
+            _SSH_LAST_USED[cache_key] = time.monotonic()
+
+def _host_connect_lock(cache_key: str) -> threading.Lock:
+    """Retorna o lock de conexão do host: chamadas simultâneas para o mesmo destino fazem um único handshake."""
+    with _CACHE_LOCK:
+        return _CONNECT_LOCKS.setdefault(cache_key, threading.Lock())
 
-    if not _is_port_open(ip, 22):
+def _open_ssh_client(ip: str, username: str, password: str, logger, auto_fix_key: bool,
+                     connect_timeout: Optional[float] = None) -> paramiko.SSHClient:
+    """
+    Abre uma nova conexão SSH (com correção automática de chave de host) e a registra no cache.
+    `connect_timeout` limita TCP, banner e autenticação a um mesmo prazo curto (ex: sondas de status).
+    """
+    cache_key = f"{username}@{ip}"
+    if connect_timeout:
+        limits = {"timeout": connect_timeout, "banner_timeout": connect_timeout, "auth_timeout": connect_timeout}
+        first_limits = second_limits = fix_limits = limits
+    else:
+        first_limits = {"timeout": 20, "banner_timeout": 60}
+        second_limits = {"timeout": 25, "banner_timeout": 60}
+        fix_limits = {"timeout": 15, "banner_timeout": 45}
+    addr = _resolve_ssh_host(ip)
+    if not _is_port_open(addr, 22, timeout=min(2.0, connect_timeout or 2.0)):
         logger.warning(f"Tentativa de conexão falhou: Porta 22 fechada em {ip}")
         raise socket.error(f"Porta 22 inacessível (Host offline ou firewall ativo).")
 
     ssh = paramiko.SSHClient()
     ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
 
+    # Só a primeira tentativa autentica sem senha (chave/agente); as demais registram o HMAC da senha usada
+    password_digest = None
     try:
         try:
             logger.info(f"Estabelecendo nova conexão SSH: {username}@{ip}")
-            ssh.connect(ip, username=username, timeout=20, banner_timeout=60, look_for_keys=True, allow_agent=True)
+            _connect_resolved(ssh, ip, addr, username=username, look_for_keys=True, allow_agent=True, **first_limits)
         except paramiko.AuthenticationException:
             if password:
                 logger.debug(f"Tentando autenticação por senha para {ip}")
-                ssh.connect(ip, username=username, password=password, timeout=25, banner_timeout=60, look_for_keys=False)
+                password_digest = _password_digest(password)
+                _connect_resolved(ssh, ip, addr, username=username, password=password, look_for_keys=False, **second_limits)
             else:
                 raise
-
-        logger.debug(f"Conexão SSH estabelecida com sucesso para {ip}")
-        with _CACHE_LOCK:
-            _SSH_CACHE[cache_key] = ssh
-        yield ssh
-        # Se chegou aqui via yield, a conexão permanece aberta no cache.
     except paramiko.SSHException as e:
-        error_str = str(e).lower()
-        is_key_error = "host key for server" in error_str and "does not match" in error_str
+        is_key_error = {"host_key", "mismatch"} <= _ssh_error_categories(str(e).lower())
 
         if is_key_error and auto_fix_key:
             logger.warning(f"Chave de host para {ip} inválida. Tentando corrigir automaticamente...")
             if _fix_host_key(ip, logger):
                 logger.info(f"Tentando reconectar a {ip} após a correção da chave...")
-                ssh.connect(ip, username=username, password=password, timeout=15, banner_timeout=45)
-                yield ssh
+                password_digest = _password_digest(password)
+                _connect_resolved(ssh, ip, addr, username=username, password=password, **fix_limits)
             else:
                 raise e
         else:
             raise e
-    # Nota: Removido o ssh.close() do finally para permitir que a conexão persista no cache global.
+
+    logger.debug(f"Conexão SSH estabelecida com sucesso para {ip}")
+    # Keepalive no transporte reaproveitado (efeito do ControlPersist do OpenSSH): mantém o mapeamento
+    # NAT/firewall vivo entre usos e faz um transporte morto ser detectado antes de sair do cache.
+    transport = ssh.get_transport()
+    if transport and SSH_KEEPALIVE_INTERVAL > 0:
+        transport.set_keepalive(SSH_KEEPALIVE_INTERVAL)
+    # Comandos e respostas curtos (bem abaixo do MTU): sem Nagle, cada pacote sai na hora em vez de
+    # esperar o ACK atrasado do pacote anterior.
+    if transport is not None:
+        try:
+            transport.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (AttributeError, OSError):
+            pass
+    with _CACHE_LOCK:
+        _SSH_CACHE[cache_key] = ssh
+        _SSH_LAST_USED[cache_key] = time.monotonic()
+        _SSH_PASSWORD_DIGESTS[cache_key] = password_digest
+        evicted = _evict_lru_ssh_clients_locked()
+    for client in evicted:
+        try:
+            client.close()
+        except Exception: pass
+    return ssh
+
+@contextmanager
+def ssh_connect(ip: str, username: str, password: str, logger, auto_fix_key: bool = True,
+                connect_timeout: Optional[float] = None) -> Generator[paramiko.SSHClient, None, None]:
+    """
+    Gerencia uma conexão SSH com tratamento de exceções e fechamento automático.
+    Implementa pooling de conexões: se a conexão estiver no cache e ativa, ela é reutilizada.
+    Enquanto o bloco estiver ativo a conexão conta como em uso e não é fechada pelo prune nem pelo LRU.
+    `connect_timeout` (opcional) encurta os prazos de conexão, banner e autenticação de uma conexão nova.
+    """
+    ssh = checkout_ssh_client(ip, username, password, logger, auto_fix_key, connect_timeout)
+    try:
+        # A conexão permanece aberta no cache global após o uso.
+        yield ssh
+    finally:
+        release_ssh_client(ip, username)
+
+# Respostas por categoria, em ordem de prioridade: (categorias exigidas, status, mensagem, detalhes com {ip}).
+_SSH_ERROR_RESPONSES = (
+    (frozenset({"auth"}), 401, "Falha na autenticação. Verifique a senha.", None),
+    (frozenset({"port_closed"}), 503, "Porta SSH (22) inacessível.",
+     "A máquina responde ao Ping, mas a porta 22 está fechada ou o firewall bloqueou a conexão."),
+    (frozenset({"timeout"}), 504, "A conexão SSH expirou (timeout).",
+     "O dispositivo demorou demais para responder. Isso geralmente ocorre em redes Wi-Fi congestionadas ou com sinal muito baixo."),
+    # Erros de conexão mais específicos
+    (frozenset({"refused"}), 503, "Host offline ou serviço SSH inativo.",
+     "Não foi possível estabelecer uma conexão SSH com {ip}. O dispositivo pode estar desligado ou o serviço SSH (sshd) não está em execução."),
+    (frozenset({"host_key", "mismatch"}), 409, "Alerta de segurança: A chave do host mudou.",
+     "A chave do host para {ip} é diferente da que está salva em 'known_hosts'. "
+     "A correção automática falhou. Isso pode significar que o sistema operacional foi reinstalado ou, em casos raros, que há um ataque 'man-in-the-middle'.\n\n"
+     "Para resolver manualmente, execute no terminal do servidor: ssh-keygen -R {ip}"),
+    (frozenset({"banner"}), 502, "Erro no protocolo SSH.",
+     "O servidor SSH em {ip} não respondeu com o banner de protocolo esperado. "
+     "Isso pode indicar que o serviço SSH não está rodando corretamente, "
+     "que há um serviço diferente na porta 22, ou um problema de rede/firewall mais profundo."),
+    (frozenset({"unknown_host"}), 409, "Host desconhecido. A chave do servidor não foi encontrada.",
+     "Por segurança, a conexão foi rejeitada. Para confiar neste host, execute o seguinte comando no terminal onde o backend está rodando e tente novamente:\nssh-keyscan -H {ip} >> ~/.ssh/known_hosts"),
+)
 
 def _handle_ssh_exception(e: Exception, ip: str, action: str, logger) -> Tuple[Dict[str, Any], int]:
     """Analisa exceções de SSH e retorna uma resposta JSON padronizada."""
     error_str = str(e).lower()
     logger.error(f"Erro de SSH na ação '{action}' em {ip}: {error_str}")
+    categories = _ssh_error_categories(error_str)
+    if isinstance(e, paramiko.AuthenticationException):
+        categories.add("auth")
 
-    if isinstance(e, paramiko.AuthenticationException) or "authentication failed" in error_str:
-        return {"success": False, "message": "Falha na autenticação. Verifique a senha."}, 401
-
-    if "inacessível" in error_str:
-        message = "Porta SSH (22) inacessível."
-        details = "A máquina responde ao Ping, mas a porta 22 está fechada ou o firewall bloqueou a conexão."
-        return {"success": False, "message": message, "details": details}, 503
-
-    if "timed out" in error_str or "timeout" in error_str or "connection timed out" in error_str:
-        message = "A conexão SSH expirou (timeout)."
-        details = "O dispositivo demorou demais para responder. Isso geralmente ocorre em redes Wi-Fi congestionadas ou com sinal muito baixo."
-        return {"success": False, "message": message, "details": details}, 504
-
-    # Adicionado para tratar erros de conexão mais específicos
-    if "unable to connect" in error_str or "connection refused" in error_str:
-        message = "Host offline ou serviço SSH inativo."
-        details = f"Não foi possível estabelecer uma conexão SSH com {ip}. O dispositivo pode estar desligado ou o serviço SSH (sshd) não está em execução."
-        return {"success": False, "message": message, "details": details}, 503
-
-    if "host key for server" in error_str and "does not match" in error_str:
-        message = "Alerta de segurança: A chave do host mudou."
-        details = (f"A chave do host para {ip} é diferente da que está salva em 'known_hosts'. "
-                   "A correção automática falhou. Isso pode significar que o sistema operacional foi reinstalado ou, em casos raros, que há um ataque 'man-in-the-middle'.\n\n"
-                   f"Para resolver manualmente, execute no terminal do servidor: ssh-keygen -R {ip}")
-        return {"success": False, "message": message, "details": details}, 409
-
-    if "error reading ssh protocol banner" in error_str:
-        message = "Erro no protocolo SSH."
-        details = (f"O servidor SSH em {ip} não respondeu com o banner de protocolo esperado. "
-                   "Isso pode indicar que o serviço SSH não está rodando corretamente, "
-                   "que há um serviço diferente na porta 22, ou um problema de rede/firewall mais profundo.")
-        return {"success": False, "message": message, "details": details}, 502
-
-    if "server not found in known_hosts" in error_str:
-        message = "Host desconhecido. A chave do servidor não foi encontrada."
-        details = f"Por segurança, a conexão foi rejeitada. Para confiar neste host, execute o seguinte comando no terminal onde o backend está rodando e tente novamente:\nssh-keyscan -H {ip} >> ~/.ssh/known_hosts"
-        return {"success": False, "message": message, "details": details}, 409
+    for required, status_code, message, details in _SSH_ERROR_RESPONSES:
+        if required <= categories:
+            response = {"success": False, "message": message}
+            if details:
+                response["details"] = details.format(ip=ip)
+            return response, status_code
 
     # Para outros erros de SSH ou exceções genéricas
     logger.error(f"Erro inesperado na ação '{action}' em {ip}: {e}")
     return {"success": False, "message": f"Erro de comunicação/execução SSH em {ip}.", "details": str(e)}, 502
 
+_STDERR_SUDO_PROMPT_RE = re.compile(r'\[sudo\] (senha|password) para .*:')
+
+def _split_remote_stderr(error_output: str) -> Tuple[str, List[str], List[str]]:
+    """Remove o prompt do sudo do stderr e separa as linhas de aviso ('W:') das de erro."""
+    cleaned_error_output = _STDERR_SUDO_PROMPT_RE.sub('', error_output).strip()
+    warnings, errors = [], []
+    # Uma única passada: cada linha é classificada uma vez, sem varrer o stderr de novo para os erros
+    for line in cleaned_error_output.splitlines():
+        stripped = line.strip()
+        if stripped.startswith('W:'):
+            warnings.append(line)
+        elif stripped:
+            errors.append(line)
+    return cleaned_error_output, warnings, errors
+
 def _execute_shell_command(ssh: paramiko.SSHClient, command: str, password: str, timeout: int = 20, username: Optional[str] = None, use_sudo: bool = True) -> Tuple[str, Optional[str], Optional[str]]:
     """
     Executa um comando shell via SSH, tratando sudo e separando warnings de erros.
@@ -184,7 +521,7 @@ def _execute_shell_command(ssh: paramiko.SSHClient, command: str, password: str,
             # A flag -H garante que o $HOME seja o do root, evitando problemas de permissão.
             final_command = f"sudo -S -H -p '' bash -c {shlex.quote(command)}"
 
-    start_time = time.time()
+    start_time = time.monotonic()
     logger.debug(f"Executando comando remoto em {ssh.get_transport().getpeername()[0]}: {final_command[:100]}...")
 
     stdin, stdout, stderr = ssh.exec_command(final_command, timeout=timeout)
@@ -197,15 +534,10 @@ def _execute_shell_command(ssh: paramiko.SSHClient, command: str, password: str,
     error_output = stderr.read().decode('utf-8', errors='ignore').strip()
     exit_status = stdout.channel.recv_exit_status()
 
-    duration = time.time() - start_time
+    duration = time.monotonic() - start_time
     logger.debug(f"Comando finalizado em {duration:.2f}s com status {exit_status}")
 
-    sudo_prompt_regex = r'\[sudo\] (senha|password) para .*:'
-    cleaned_error_output = re.sub(sudo_prompt_regex, '', error_output).strip()
-
-    all_error_lines = cleaned_error_output.splitlines()
-    warnings = [line for line in all_error_lines if line.strip().startswith('W:')]
-    errors = [line for line in all_error_lines if not line.strip().startswith('W:') and line.strip()]
+    cleaned_error_output, warnings, errors = _split_remote_stderr(error_output)
 
     if exit_status != 0:
         error_details = "\n".join(errors) if errors else cleaned_error_output
@@ -217,6 +549,81 @@ def _execute_shell_command(ssh: paramiko.SSHClient, command: str, password: str,
 
     return output, "\n".join(warnings) if warnings else None, "\n".join(errors) if errors else None
 
+# Usuários com pasta em /home e shell de login
+_LIST_HOME_USERS_CMD = r"getent passwd | awk -F: '$6 ~ /^\/home\// && $7 !~ /nologin|false/ {print $1}'"
+
+def _execute_shell_command_for_users(ssh: paramiko.SSHClient, command: str, password: str,
+                                     target_user: Optional[str] = None, timeout: int = 20) -> Dict[str, Tuple[int, str, str]]:
+    """
+    Executa o mesmo comando para os usuários da máquina em um único canal SSH.
+    O sudo é autenticado uma só vez; o script remoto lista os usuários no momento da execução (restrito a
+    `target_user` se ele existir), roda o comando de cada um em paralelo e devolve, separados por NUL,
+    (usuário, status, stdout, stderr).
+    """
+    script = f"""
+tmp=$(mktemp -d) || exit 1
+users=$({_LIST_HOME_USERS_CMD})
+t={shlex.quote(target_user or "")}
+if [ -n "$t" ] && printf '%s\n' $users | grep -qxF -- "$t"; then users=$t; fi
+for u in $users; do
+    ( sudo -H -u "$u" bash -c {shlex.quote(command)} >"$tmp/$u.out" 2>"$tmp/$u.err"; echo $? >"$tmp/$u.rc" ) &
+done
+wait
+for u in $users; do
+    printf '%s\\0%s\\0%s\\0%s\\0' "$u" "$(cat "$tmp/$u.rc")" "$(cat "$tmp/$u.out")" "$(cat "$tmp/$u.err")"
+done
+rm -rf "$tmp"
+"""
+    final_command = f"sudo -S -H -p '' bash -c {shlex.quote(script)}"
+    logger.debug(f"Executando comando remoto em lote para os usuários de {ssh.get_transport().getpeername()[0]}: {command[:100]}...")
+
+    stdin, stdout, stderr = ssh.exec_command(final_command, timeout=timeout)
+    # Daqui em diante o script pode já ter rodado para parte dos usuários: qualquer falha vira
+    # CommandExecutionError, para o chamador não repetir o comando usuário a usuário.
+    try:
+        stdin.write(password + '\n')
+        stdin.flush()
+
+        raw_output = stdout.read().decode('utf-8', errors='ignore')
+        error_output = stderr.read().decode('utf-8', errors='ignore').strip()
+        exit_status = stdout.channel.recv_exit_status()
+    except Exception as e:
+        raise CommandExecutionError(message=f"A execução em lote foi interrompida: {e}", details=str(e)) from e
+
+    fields = raw_output.split('\0')
+    results = {}
+    for i in range(0, len(fields) - 3, 4):
+        user, rc, out, err = fields[i:i + 4]
+        user = user.strip()
+        try:
+            results[user] = (int(rc.strip() or 1), out.strip(), err.strip())
+        except ValueError:
+            results[user] = (1, out.strip(), err.strip())
+
+    if exit_status != 0 and not results:
+        _, warnings, errors = _split_remote_stderr(error_output)
+        raise CommandExecutionError(
+            message=f"O comando falhou com o código de saída {exit_status}.",
+            details="\n".join(errors) if errors else error_output,
+            warnings="\n".join(warnings) if warnings else None
+        )
+    return results
+
+# Saída do streaming é agrupada: envia as linhas completas acumuladas a cada 4 KB ou 50 ms,
+# em vez de um write HTTP por recv(). Uma linha parcial parada por 0,5 s (ex: prompt) é enviada mesmo assim.
+_STREAM_FLUSH_BYTES = 4096
+_STREAM_FLUSH_INTERVAL = 0.05
+_STREAM_PARTIAL_FLUSH = 0.5
+# Espera máxima no seletor sem saída pendente: limita a demora em notar um término sem evento no canal
+_STREAM_IDLE_WAIT = 0.5
+_SUDO_PROMPT_RE = re.compile(r'\[sudo\].*?password for.*?:', re.IGNORECASE)
+
+def _clean_stream_text(text: str) -> str:
+    """Remove o prompt do sudo e linhas vazias de um bloco de saída; devolve '' se nada sobrar."""
+    lines = [line.rstrip() for line in _SUDO_PROMPT_RE.sub('', text).splitlines()]
+    lines = [line for line in lines if line.strip()]
+    return '\n'.join(lines) + '\n' if lines else ''
+
 def _stream_shell_command(ssh: paramiko.SSHClient, command: str, password: str, timeout: int = 300, use_sudo: bool = True) -> Generator[str, None, int]:
     """
     Executa um comando shell via SSH e transmite a saída (stdout e stderr) em tempo real.
@@ -238,7 +645,11 @@ def _stream_shell_command(ssh: paramiko.SSHClient, command: str, password: str,
     channel = ssh.get_transport().open_session()
     channel.set_combine_stderr(True)  # Combina stdout e stderr em um único fluxo.
     channel.get_pty() # Solicita um pseudo-terminal, necessário para algumas interações.
-    
+    # O canal paramiko é selecionável (fileno): entre um pedaço e outro a thread dorme no seletor
+    # até chegar saída, em vez de acordar a cada 50 ms durante atualizações de vários minutos.
+    sel = selectors.DefaultSelector()
+    sel.register(channel, selectors.EVENT_READ)
+
     try:
         channel.exec_command(final_command)
 
@@ -246,22 +657,58 @@ def _stream_shell_command(ssh: paramiko.SSHClient, command: str, password: str,
         if use_sudo and "sudo -S" in final_command:
             channel.sendall(password + '\n')
 
-        # Lê a saída linha por linha enquanto o comando estiver em execução.
-        while not channel.exit_status_ready():
-            # Verifica se há dados para ler para evitar bloqueio.
+        # Decodificador incremental: um caractere UTF-8 dividido entre dois recv() não é perdido.
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        # Pedaços ainda não enviados ficam em lista (juntados uma vez por envio, não a cada recv) e só o
+        # pedaço novo é varrido atrás de '\n': saídas longas sem quebra de linha (barras de progresso) não
+        # são recopiadas nem revarridas a cada volta.
+        pending = []
+        pending_len = 0
+        has_newline = False
+        last_flush = time.monotonic()
+        while True:
+            # Drena tudo o que já chegou antes de checar o término, para não perder o final da saída.
             if channel.recv_ready():
-                line = channel.recv(1024).decode('utf-8', errors='ignore')
-                # Remove o prompt de senha da saída para não exibi-lo no frontend.
-                cleaned_line = re.sub(r'\[sudo\].*?password for.*?:', '', line, flags=re.IGNORECASE).strip()
-                if cleaned_line:
-                    yield cleaned_line + '\n' # Adiciona nova linha para o streaming
+                chunk = decoder.decode(channel.recv(65536))
+                if chunk:
+                    pending.append(chunk)
+                    pending_len += len(chunk)
+                    has_newline = has_newline or '\n' in chunk
+            elif channel.exit_status_ready():
+                break
             else:
-                # Pequena pausa para evitar uso excessivo de CPU em loop busy-wait
-                time.sleep(0.1)
-        
+                # Com saída pendente, acorda a tempo do próximo envio; sem ela, só quando chegar dado
+                sel.select(timeout=_STREAM_FLUSH_INTERVAL if pending else _STREAM_IDLE_WAIT)
+
+            if not pending:
+                continue
+            elapsed = time.monotonic() - last_flush
+            if has_newline and (pending_len >= _STREAM_FLUSH_BYTES or elapsed >= _STREAM_FLUSH_INTERVAL):
+                complete, _, rest = ''.join(pending).rpartition('\n')
+                pending = [rest] if rest else []
+                pending_len = len(rest)
+                has_newline = False
+            elif elapsed >= _STREAM_PARTIAL_FLUSH:
+                complete = ''.join(pending)
+                pending = []
+                pending_len = 0
+                has_newline = False
+            else:
+                continue
+            last_flush = time.monotonic()
+            # Remove o prompt de senha da saída para não exibi-lo no frontend.
+            text = _clean_stream_text(complete)
+            if text:
+                yield text
+
+        text = _clean_stream_text(''.join(pending) + decoder.decode(b'', final=True))
+        if text:
+            yield text
+
         # Retorna o código de saída final.
         return channel.recv_exit_status()
     finally:
+        sel.close()
         channel.close()
 
 def _get_remote_desktop_path(ssh: paramiko.SSHClient, sftp: paramiko.SFTPClient, username: str) -> Optional[str]:
@@ -385,7 +832,8 @@ def list_sftp_backups(ssh: paramiko.SSHClient, backup_root_dir: str) -> Dict[str
         except FileNotFoundError:
             return {}
 
-        backup_dirs = [d for d in sftp.listdir(backup_root) if stat.S_ISDIR(sftp.stat(posixpath.join(backup_root, d)).st_mode)]
+        # listdir_attr traz nome e modo numa só resposta SFTP, sem um stat por entrada
+        backup_dirs = [a.filename for a in sftp.listdir_attr(backup_root) if stat.S_ISDIR(a.st_mode or 0)]
         backups_by_dir = {}
         for directory in backup_dirs:
             dir_path = posixpath.join(backup_root, directory)
@@ -527,6 +975,61 @@ def _process_generic_shell_action_for_user(ssh: paramiko.SSHClient, user: str, a
         logger.error(f"Exceção inesperada na ação '{action}' para o usuário '{user}': {e}")
         return {"success": False, "message": "Ocorreu uma exceção inesperada no servidor.", "details": str(e)}
 
+def _shell_result_to_response(exit_status: int, output: str, error_output: str) -> Dict[str, Any]:
+    """Converte o resultado bruto de um comando no mesmo payload de `_handle_shell_action`."""
+    cleaned_error_output, warning_lines, error_lines = _split_remote_stderr(error_output)
+    warnings = "\n".join(warning_lines) if warning_lines else None
+    errors = "\n".join(error_lines) if error_lines else None
+
+    if exit_status != 0:
+        details = []
+        if warnings: details.append(f"Avisos: {warnings}")
+        details.append(f"Erros: {errors or cleaned_error_output}")
+        return {"success": False, "message": "Ocorreu um erro no dispositivo remoto.", "details": "\n".join(details)}
+
+    final_details = None
+    if warnings or errors:
+        details_list = []
+        if warnings: details_list.append(f"Avisos:\n{warnings}")
+        if errors: details_list.append(f"Erros não fatais:\n{errors}")
+        final_details = "\n\n".join(details_list)
+    return {"success": True, "message": output or "Ação executada com sucesso.", "details": final_details}
+
+def _run_generic_action_for_users(ssh: paramiko.SSHClient, action: str, data: Dict[str, Any], logger) -> Optional[Dict[str, Dict[str, Any]]]:
+    """
+    Executa uma ação shell genérica para todos os usuários (listados no próprio script) em um único round-trip SSH.
+    Retorna None quando a ação não pode ser agrupada ou o canal falhou antes do envio do comando, para que o
+    chamador use o caminho por usuário. Depois do envio, uma falha levanta CommandExecutionError (nunca reexecuta).
+    """
+    command_builder = _get_command_builder(action)
+    if not command_builder:
+        return None
+    if callable(command_builder):
+        command, error_response = command_builder(data)
+        if error_response:
+            # O caminho por usuário reporta o mesmo erro para cada usuário, sem executar nada
+            return None
+    else:
+        command = command_builder
+
+    target_user = (data.get('target_user') or '').strip() or None
+    try:
+        raw_results = _execute_shell_command_for_users(ssh, command, data.get('password'), target_user)
+    except CommandExecutionError:
+        raise
+    except Exception as e:
+        logger.warning(f"Execução em lote da ação '{action}' falhou, usando execução por usuário: {e}")
+        return None
+
+    return {user: _shell_result_to_response(*raw) for user, raw in raw_results.items()}
+
+def _list_remote_home_users(ssh: paramiko.SSHClient) -> Tuple[List[str], str]:
+    """Lista os usuários com pasta em /home e shell de login."""
+    _, stdout, stderr = ssh.exec_command(_LIST_HOME_USERS_CMD)
+    users = stdout.read().decode().strip().splitlines()
+    err = stderr.read().decode().strip()
+    return users, err
+
 # Dispatch table for user-specific actions
 USER_ACTION_HANDLERS = {
     'definir_papel_de_parede': _process_wallpaper_action_for_user,
@@ -546,13 +1049,26 @@ USER_ACTION_HANDLERS = {
 # é configurada para ser executada por usuário.
 def _execute_for_each_user(ssh: paramiko.SSHClient, action: str, data: Dict[str, Any], logger) -> Dict[str, Any]:
     """Encontra e executa uma ação para cada usuário na máquina remota."""
-    list_users_cmd = r"getent passwd | awk -F: '$6 ~ /^\/home\// && $7 !~ /nologin|false/ {print $1}'"
-    _, stdout, stderr = ssh.exec_command(list_users_cmd)
-    users = stdout.read().decode().strip().splitlines()
-    err = stderr.read().decode().strip()
+    no_users_response = {"success": False, "message": "Não foi possível encontrar usuários na máquina remota.", "details": "Nenhum usuário com pasta home detectado."}
+
+    # Ações shell genéricas: a lista de usuários sai do próprio script em lote (sempre atual, sem exec extra)
+    handler = USER_ACTION_HANDLERS.get(action, _process_generic_shell_action_for_user)
+    if handler is _process_generic_shell_action_for_user:
+        try:
+            batch_results = _run_generic_action_for_users(ssh, action, data, logger)
+        except CommandExecutionError as e:
+            logger.error(f"Erro na ação '{action}' em lote: {e.details}")
+            details = []
+            if e.warnings: details.append(f"Avisos: {e.warnings}")
+            if e.details: details.append(f"Erros: {e.details}")
+            return {"success": False, "message": "Ocorreu um erro no dispositivo remoto.", "details": "\n".join(details)}
+        if batch_results is not None:
+            return _summarize_user_results(action, batch_results) if batch_results else no_users_response
+
+    users, err = _list_remote_home_users(ssh)
 
     if not users:
-        return {"success": False, "message": "Não foi possível encontrar usuários na máquina remota.", "details": err or "Nenhum usuário com pasta home detectado."}
+        return {**no_users_response, "details": err or no_users_response["details"]}
 
     # Filtra por usuário específico se solicitado (para ambientes multiseat)
     target_user = data.get('target_user')
@@ -563,7 +1079,7 @@ def _execute_for_each_user(ssh: paramiko.SSHClient, action: str, data: Dict[str,
             users = [target_user]
 
     results = {}
-    
+
     def run_user_action(user):
         try:
             handler = USER_ACTION_HANDLERS.get(action, _process_generic_shell_action_for_user)
@@ -579,6 +1095,10 @@ def _execute_for_each_user(ssh: paramiko.SSHClient, action: str, data: Dict[str,
             user, result = future.result()
             results[user] = result
 
+    return _summarize_user_results(action, results)
+
+def _summarize_user_results(action: str, results: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """Monta a resposta agregada (resumo + resultado por usuário) de uma ação executada por usuário."""
     # --- Lógica de Relatório Aprimorada ---
     # Verifica se a operação foi um sucesso para todos os usuários.
     all_success = all(r.get('success', False) for r in results.values())
@@ -586,7 +1106,7 @@ def _execute_for_each_user(ssh: paramiko.SSHClient, action: str, data: Dict[str,
     success_count = sum(1 for r in results.values() if r.get('success', False))
 
     # Cria uma mensagem de resumo mais informativa.
-    summary_message = f"Ação '{action}' concluída para {success_count} de {len(users)} usuário(s)."
+    summary_message = f"Ação '{action}' concluída para {success_count} de {len(results)} usuário(s)."
 
     # O payload de resposta agora inclui a mensagem de resumo e um dicionário
     # detalhado com o resultado para cada usuário.
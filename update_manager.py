@@ -42,8 +42,9 @@ def run_command(command: list, env: dict = None) -> Optional[subprocess.Complete
 
 def wait_for_lock(lock_path: str, env: dict, timeout: int = 60) -> bool:
     """Aguarda a liberação de um arquivo de bloqueio (lock file)."""
-    start_time = time.time()
-    while time.time() - start_time < timeout:
+    # Relógio monotônico: um ajuste de hora (NTP) durante a espera não encurta nem estende o prazo.
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
         # fuser retorna 0 se o arquivo estiver em uso, 1 se estiver livre.
         fuser_result = run_command(["fuser", lock_path], env)
         
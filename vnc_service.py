@@ -20,6 +20,10 @@ import tempfile
 
 import subprocess
 
+import signal
+
+import contextlib
+
 import base64
 
 from typing import Dict, Optional, Any
@@ -28,6 +32,8 @@ import paramiko
 
 import struct
 
+from collections import deque
+
 
 
 from ssh_service import ssh_connect
@@ -43,6 +49,21 @@ _WEBSOCKIFY_PROCS: Dict[int, subprocess.Popen] = {}
 _VNC_LOCK = threading.Lock()
 
 
+# Plataforma e executável do websockify resolvidos uma única vez na importação (não mudam durante a execução)
+
+_IS_WINDOWS = os.name == 'nt'
+
+# POSIX: sessão própria para encerrar o grupo inteiro; Windows: sem abrir janela de console
+
+_WEBSOCKIFY_POPEN_KWARGS = {"creationflags": subprocess.CREATE_NO_WINDOW} if _IS_WINDOWS else {"start_new_session": True}
+
+# Executável do websockify no ambiente virtual ou, na falta dele, via módulo
+
+_WEBSOCKIFY_BIN = os.path.join(os.path.dirname(sys.executable), "websockify.exe" if _IS_WINDOWS else "websockify")
+
+_WEBSOCKIFY_BASE_CMD = [_WEBSOCKIFY_BIN] if os.path.isfile(_WEBSOCKIFY_BIN) else [sys.executable, "-m", "websockify"]
+
+
 
 def _is_port_open(ip: str, port: int = 5900, timeout: float = 2.0) -> bool:
 
@@ -60,153 +81,399 @@ def _is_port_open(ip: str, port: int = 5900, timeout: float = 2.0) -> bool:
 
 
 
+def _send_sudo_password(stdin, password: str):
+
+    """
+
+    Envia a senha ao `sudo -S` pelo stdin do canal SSH, em vez de embuti-la no comando remoto
+
+    (onde ficaria visível em /proc/*/cmdline do shell remoto enquanto ele roda).
+
+    """
+
+    try:
+
+        stdin.write(password + '\n')
+
+        stdin.flush()
+
+    except (OSError, EOFError):
+
+        # O comando já terminou sem ler o stdin (ex: nada a instalar)
+
+        pass
+
+
+
+# Portas do websockify liberadas recentemente (reaproveitadas antes de varrer a faixa) e portas já
+
+# entregues a uma preparação em andamento mas ainda não registradas em _WEBSOCKIFY_PROCS (porta -> expiração).
+
+# Evita que duas preparações simultâneas de IPs diferentes escolham a mesma porta livre.
+
+_WS_PORT_POOL: deque = deque(maxlen=64)
+
+_WS_PORTS_PENDING: Dict[int, float] = {}
+
+_WS_PORT_RESERVATION_TTL = 60.0
+
+def _can_bind_ws_port(port: int) -> bool:
+
+    """Testa se a porta local pode ser ligada (mesmo bind que o websockify fará, com SO_REUSEADDR)."""
+
+    try:
+
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+            s.bind(("", port))
+
+            return True
+
+    except OSError:
+
+        return False
+
 def find_free_ws_port(preferred_port: int = 6080, start_port: int = 6080, max_port: int = 6200) -> int:
 
-    """Retorna uma porta TCP local livre para o websockify, excluindo portas já em uso por procs registrados."""
+    """
 
-    with _VNC_LOCK:
+    Retorna uma porta TCP local livre para o websockify e a reserva até start_websockify_proxy registrá-la.
 
-        reserved = set(_WEBSOCKIFY_PROCS.keys())
+    Ordem: porta preferida, portas liberadas recentemente e, por fim, a varredura da faixa.
 
+    """
+
+    with _VNC_LOCK:
 
+        now = time.monotonic()
 
-    def is_available(port: int) -> bool:
+        for port, expires in list(_WS_PORTS_PENDING.items()):
 
-        if port in reserved:
+            if expires <= now:
 
-            return False
+                del _WS_PORTS_PENDING[port]
 
-        return not _is_port_open("127.0.0.1", port, timeout=0.2)
+        reserved = set(_WEBSOCKIFY_PROCS) | set(_WS_PORTS_PENDING)
 
+        recycled = [p for p in _WS_PORT_POOL if p not in reserved]
 
+        _WS_PORT_POOL.clear()
 
-    if is_available(preferred_port):
+        for port in (preferred_port, *recycled, *range(start_port, max_port)):
 
-        return preferred_port
+            if port not in reserved and _can_bind_ws_port(port):
 
-    for port in range(start_port, max_port):
+                _WS_PORTS_PENDING[port] = now + _WS_PORT_RESERVATION_TTL
 
-        if is_available(port):
+                # Portas recicladas não usadas voltam para o pool
 
-            return port
+                _WS_PORT_POOL.extend(p for p in recycled if p != port)
+
+                return port
 
     return preferred_port
 
 
 
+def _reap_process(proc: subprocess.Popen, grace: float = 1.5):
+
+    """
+
+    Encerra o processo e todo o seu grupo (o websockify cria um processo filho por cliente conectado),
+
+    com SIGTERM e, se não sair em `grace` segundos, SIGKILL. No Windows, só o próprio processo.
+
+    """
+
+    use_group = not _IS_WINDOWS
+
+    if use_group:
+
+        with contextlib.suppress(ProcessLookupError, PermissionError):
+
+            os.killpg(proc.pid, signal.SIGTERM)
+
+    elif proc.poll() is None:
+
+        proc.terminate()
+
+    try:
+
+        proc.wait(timeout=grace)
+
+    except subprocess.TimeoutExpired:
+
+        if use_group:
+
+            with contextlib.suppress(ProcessLookupError, PermissionError):
+
+                os.killpg(proc.pid, signal.SIGKILL)
+
+        else:
+
+            proc.kill()
+
+        proc.wait()
+
 
 
 def stop_websockify_proxy(ws_port: int):
 
     """Encerra um processo websockify rodando em determinada porta."""
 
+    # Só a retirada do registro fica sob o lock; o encerramento (até alguns segundos) roda fora dele
+
     with _VNC_LOCK:
 
         proc = _WEBSOCKIFY_PROCS.pop(ws_port, None)
 
         if proc:
 
-            try:
+            _WS_PORT_POOL.append(ws_port)
+
+    if proc:
 
-                if proc.poll() is None:
+        try:
 
-                    proc.terminate()
+            _reap_process(proc)
 
-                    try:
+        except Exception as e:
 
-                        proc.wait(timeout=1.5)
+            logger.warning(f"Erro ao encerrar websockify na porta {ws_port}: {e}")
 
-                    except Exception:
+    # Pequena pausa para deixar a porta sair do estado TIME_WAIT antes de reusar
 
-                        proc.kill()
+    # (só quando havia um processo encerrado nesta porta)
 
-            except Exception as e:
+    if proc:
 
-                logger.warning(f"Erro ao encerrar websockify na porta {ws_port}: {e}")
+        time.sleep(0.3)
 
-    # Pequena pausa para deixar a porta sair do estado TIME_WAIT antes de reusar
 
-    time.sleep(0.3)
 
+def prune_websockify_procs(logger: logging.Logger) -> int:
 
+    """
 
-def start_websockify_proxy(target_ip: str, target_port: int = 5900, ws_port: int = 6080) -> Optional[int]:
+    Retira do registro os websockify que já encerraram sozinhos (ex: host desligado), sem bloquear:
 
-    """Inicia o proxy websockify local ligando ws_port (WebSocket) -> target_ip:target_port (RFB TCP)."""
+    proc.poll() é um waitpid(WNOHANG) só daquele PID, então não há espera nem conflito com outros
 
-    stop_websockify_proxy(ws_port)
+    subprocessos da aplicação. Evita processos zumbis e devolve as portas ao pool. Retorna quantos saíram.
 
+    """
 
+    with _VNC_LOCK:
 
-    log_path = os.path.join(tempfile.gettempdir(), f"websockify_{ws_port}.log")
+        exited = [(port, proc) for port, proc in _WEBSOCKIFY_PROCS.items() if proc.poll() is not None]
 
-    
+        for port, _ in exited:
 
-    # Determina o executável do websockify no ambiente virtual ou via módulo
+            del _WEBSOCKIFY_PROCS[port]
 
-    venv_bin = os.path.dirname(sys.executable)
+            _WS_PORT_POOL.append(port)
 
-    websockify_bin = os.path.join(venv_bin, "websockify.exe" if os.name == 'nt' else "websockify")
+    for port, proc in exited:
+
+        logger.debug(f"websockify da porta {port} encerrou (code={proc.returncode}); removido do registro.")
+
+    return len(exited)
 
-    
 
-    if os.path.isfile(websockify_bin):
 
-        cmd = [websockify_bin, "--log-file", log_path, str(ws_port), f"{target_ip}:{target_port}"]
+# Linha que o websockify registra só depois de ligar a porta de escuta
 
-    else:
+_WS_LISTENING_MARKER = b"proxying from"
 
-        cmd = [sys.executable, "-m", "websockify", "--log-file", log_path, str(ws_port), f"{target_ip}:{target_port}"]
+# Sem essa linha no log, a porta aberta só conta como do websockify se ele seguir vivo por este tempo
 
+_WS_READY_GRACE = 1.0
 
+def _log_contains(path: str, offset: int, marker: bytes) -> bool:
+
+    """Indica se o log contém `marker` a partir de `offset` (só o trecho escrito por esta execução)."""
 
     try:
 
-        logger.info(f"Iniciando websockify: {' '.join(cmd)}")
+        with open(path, 'rb') as f:
+
+            f.seek(offset)
+
+            return marker in f.read()
+
+    except OSError:
+
+        return False
+
+def _wait_websockify_ready(proc: subprocess.Popen, ws_port: int, log_path: str, log_offset: int,
+
+                           timeout: float = 4.0) -> str:
+
+    """
+
+    Aguarda o websockify escutar em ws_port, verificando a cada 0.1s. Retorna "ready", "exited" ou "timeout".
+
+    A porta aberta não basta (outro processo pode tê-la ocupado antes do bind do websockify): só é "ready"
+
+    com a linha de escuta no log ou com o processo ainda vivo _WS_READY_GRACE segundos depois.
+
+    """
+
+    deadline = time.monotonic() + timeout
+
+    opened_at = None
+
+    while True:
+
+        if proc.poll() is not None:
+
+            return "exited"
+
+        now = time.monotonic()
+
+        if opened_at is None and _is_port_open("127.0.0.1", ws_port, timeout=0.2):
+
+            opened_at = now
+
+        if opened_at is not None and (now - opened_at >= _WS_READY_GRACE
+
+                                      or _log_contains(log_path, log_offset, _WS_LISTENING_MARKER)):
+
+            return "ready"
+
+        remaining = deadline - now
+
+        if remaining <= 0:
+
+            return "timeout"
+
+        time.sleep(min(0.1, remaining))
+
+def _read_log_tail(path: str, max_bytes: int = 4096) -> str:
 
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    """Retorna o final do arquivo de log (para diagnóstico), ou string vazia se não puder ser lido."""
+
+    try:
+
+        with open(path, 'rb') as f:
+
+            f.seek(0, os.SEEK_END)
+
+            f.seek(max(0, f.tell() - max_bytes))
+
+            return f.read().decode('utf-8', errors='ignore').strip()
+
+    except OSError:
+
+        return ""
+
+
+
+# Tentativas de subir o websockify quando outro processo ocupa a porta escolhida antes do bind
+
+_WS_BIND_ATTEMPTS = 3
+
+def start_websockify_proxy(target_ip: str, target_port: int = 5900, ws_port: int = 6080) -> Optional[int]:
+
+    """
+
+    Inicia o proxy websockify local ligando ws_port (WebSocket) -> target_ip:target_port (RFB TCP).
+
+    Se um processo externo ocupar a porta entre a escolha e o bind do websockify, sobe em outra porta livre
+
+    em vez de falhar. Retorna a porta efetivamente usada, ou None.
+
+    """
+
+    for _ in range(_WS_BIND_ATTEMPTS):
+
+        port = _spawn_websockify_proxy(target_ip, target_port, ws_port)
+
+        if port is not None or _can_bind_ws_port(ws_port):
+
+            return port
+
+        logger.warning(f"Porta {ws_port} ocupada por outro processo antes do websockify; tentando outra porta.")
+
+        ws_port = find_free_ws_port(preferred_port=ws_port + 1)
+
+    return None
+
+
+
+def _spawn_websockify_proxy(target_ip: str, target_port: int, ws_port: int) -> Optional[int]:
+
+    """Uma tentativa de subir o websockify em ws_port (ver start_websockify_proxy)."""
+
+    stop_websockify_proxy(ws_port)
+
+    # Porta já ocupada por outro processo: nem inicia (o chamador tenta outra porta)
+
+    if not _can_bind_ws_port(ws_port):
 
         with _VNC_LOCK:
 
-            _WEBSOCKIFY_PROCS[ws_port] = proc
+            _WS_PORTS_PENDING.pop(ws_port, None)
+
+        return None
 
 
 
-        # Aguarda até 4 segundos para a porta ficar ativa localmente
+    log_path = os.path.join(tempfile.gettempdir(), f"websockify_{ws_port}.log")
 
-        for _ in range(8):
+    
 
-            time.sleep(0.5)
+    cmd = [*_WEBSOCKIFY_BASE_CMD, "--log-file", log_path, str(ws_port), f"{target_ip}:{target_port}"]
 
-            if proc.poll() is not None:
 
-                # Captura stderr para diagnóstico
 
-                try:
+    try:
 
-                    _, stderr_data = proc.communicate(timeout=1)
+        logger.info(f"Iniciando websockify: {' '.join(cmd)}")
 
-                    stderr_msg = stderr_data.decode('utf-8', errors='ignore').strip()
+        # A saída do websockify nunca é lida depois da subida: um PIPE sem leitor encheria (64 KB) e
 
-                except Exception:
+        # travaria o proxy no meio da sessão. stdout vai para /dev/null e stderr para o próprio log.
 
-                    stderr_msg = ""
+        with open(log_path, 'ab') as log_file:
 
-                logger.error(f"websockify encerrou prematuramente (code={proc.returncode}). stderr: {stderr_msg or '(sem saída)'}. Log: {log_path}")
+            log_offset = log_file.tell()
 
-                with _VNC_LOCK:
+            proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=log_file, **_WEBSOCKIFY_POPEN_KWARGS)
 
-                    _WEBSOCKIFY_PROCS.pop(ws_port, None)
+        with _VNC_LOCK:
+
+            _WEBSOCKIFY_PROCS[ws_port] = proc
+
+            _WS_PORTS_PENDING.pop(ws_port, None)
+
+
+
+        # Aguarda até 4 segundos para a porta ficar ativa localmente
 
-                return None
+        status = _wait_websockify_ready(proc, ws_port, log_path, log_offset)
 
-            if _is_port_open("127.0.0.1", ws_port, timeout=0.5):
+        if status == "exited":
 
-                logger.info(f"websockify ativo na porta local {ws_port} -> {target_ip}:{target_port}")
+            # Final do log (inclui o stderr) para diagnóstico
 
-                return ws_port
+            stderr_msg = _read_log_tail(log_path)
 
+            logger.error(f"websockify encerrou prematuramente (code={proc.returncode}). saída: {stderr_msg or '(sem saída)'}. Log: {log_path}")
 
+            with _VNC_LOCK:
+
+                _WEBSOCKIFY_PROCS.pop(ws_port, None)
+
+            return None
+
+        if status == "ready":
+
+            logger.info(f"websockify ativo na porta local {ws_port} -> {target_ip}:{target_port}")
+
+            return ws_port
 
         logger.warning(f"Timeout aguardando porta {ws_port} do websockify. Retornando porta assim mesmo.")
 
@@ -224,8 +491,63 @@ def start_websockify_proxy(target_ip: str, target_port: int = 5900, ws_port: int
 
 
 
+# Apelidos de assento (multiseat) -> índice do display detectado, na ordem de prioridade
+
+_SEAT_ALIASES = (
+
+    (('seat1', 'aluno2'), '1', 1),
+
+    (('seat0', 'aluno1'), '0', 0),
+
+)
+
+
+
+def _seat_alias_display(name: str, displays: list) -> Optional[str]:
+
+    """Resolve um apelido de assento (ex: 'seat1', 'aluno2', '1') para o display correspondente."""
+
+    lowered = name.lower()
+
+    for keywords, exact, index in _SEAT_ALIASES:
+
+        if name == exact or any(k in lowered for k in keywords):
+
+            return displays[index] if len(displays) > index else f":{index}"
+
+    return None
+
+
+
+# Locks por "ip/display": duas preparações simultâneas do mesmo assento (ex: clique duplo no grid)
+
+# não fazem pkill/reinício do x11vnc uma por cima da outra; a segunda espera e reaproveita o resultado.
+
+_VNC_START_LOCKS: Dict[str, threading.Lock] = {}
+
+
+def _vnc_start_lock(ip: str, target_display: Optional[str]) -> threading.Lock:
+
+    """Retorna o lock de preparação VNC do assento (criado sob _VNC_LOCK na primeira vez)."""
+
+    with _VNC_LOCK:
+
+        return _VNC_START_LOCKS.setdefault(f"{ip}/{target_display or ''}", threading.Lock())
+
+
+
 def ensure_remote_vnc_server(ip: str, username: str, password: str, logger: logging.Logger, target_display: Optional[str] = None) -> Dict[str, Any]:
 
+    """Garante um x11vnc + websockify para o assento, serializando chamadas simultâneas para o mesmo ip/display."""
+
+    with _vnc_start_lock(ip, target_display):
+
+        return _ensure_remote_vnc_server(ip, username, password, logger, target_display)
+
+
+
+def _ensure_remote_vnc_server(ip: str, username: str, password: str, logger: logging.Logger, target_display: Optional[str] = None) -> Dict[str, Any]:
+
     """
 
     Garante que um servidor x11vnc esteja rodando na máquina remota.
@@ -308,17 +630,9 @@ def ensure_remote_vnc_server(ip: str, username: str, password: str, logger: logg
 
                         target_display = f":{target_display}"
 
-                    elif 'seat1' in target_display.lower() or 'aluno2' in target_display.lower() or target_display == '1':
-
-                        target_display = displays[1] if len(displays) > 1 else ":1"
-
-                    elif 'seat0' in target_display.lower() or 'aluno1' in target_display.lower() or target_display == '0':
-
-                        target_display = displays[0] if len(displays) > 0 else ":0"
-
                     else:
 
-                        target_display = displays[0] if displays else ":0"
+                        target_display = _seat_alias_display(target_display, displays) or (displays[0] if displays else ":0")
 
 
 
@@ -356,11 +670,11 @@ def ensure_remote_vnc_server(ip: str, username: str, password: str, logger: logg
 
                 # Instala x11vnc se necessário
 
-                install_cmd = f"which x11vnc >/dev/null 2>&1 || timeout 45 bash -c \"echo '{password}' | sudo -S apt-get update >/dev/null 2>&1; echo '{password}' | sudo -S apt-get install -y x11vnc >/dev/null 2>&1\""
+                install_cmd = "which x11vnc >/dev/null 2>&1 || sudo -S -p '' timeout 45 bash -c 'apt-get update >/dev/null 2>&1; apt-get install -y x11vnc >/dev/null 2>&1'"
 
-                install_cmd = install_cmd.replace('\r', '')
+                stdin, _, _ = ssh.exec_command(install_cmd, timeout=15)
 
-                ssh.exec_command(install_cmd, timeout=15)
+                _send_sudo_password(stdin, password)
 
 
 
@@ -472,23 +786,31 @@ chmod 666 /tmp/x11vnc_$RFBPORT.log 2>/dev/null || true
 
                 b64_script = base64.b64encode(script_body.encode('utf-8')).decode('utf-8')
 
-                vnc_cmd = f"echo {shlex.quote(password)} | sudo -S -p '' bash -c 'echo {b64_script} | base64 -d | bash'"
-
-                vnc_cmd = vnc_cmd.replace('\r', '')
+                vnc_cmd = f"sudo -S -p '' bash -c 'echo {b64_script} | base64 -d | bash'"
 
                 stdin, stdout, stderr = ssh.exec_command(vnc_cmd, get_pty=True, timeout=15)
 
+                _send_sudo_password(stdin, password)
+
                 cmd_out = stdout.read().decode('utf-8', errors='ignore').strip()
 
+                # Com PTY, a senha digitada no stdin volta como eco na saída: remove antes de logar
+
+                if password:
+
+                    cmd_out = cmd_out.replace(password, '').strip()
+
                 logger.debug(f"SSH Output ({ip}): {cmd_out}")
 
 
 
-                # Aguarda até 5 segundos para a porta VNC abrir
+                # Aguarda até 5 segundos para a porta VNC abrir: testa já na primeira volta
+
+                # (o x11vnc -bg costuma estar pronto quando o script retorna) e depois a cada 0,2s
 
-                for _ in range(10):
+                vnc_deadline = time.monotonic() + 5.0
 
-                    time.sleep(0.5)
+                while True:
 
                     if _is_port_open(ip, rfbport, timeout=1.0):
 
@@ -498,6 +820,12 @@ chmod 666 /tmp/x11vnc_$RFBPORT.log 2>/dev/null || true
 
                         break
 
+                    if time.monotonic() >= vnc_deadline:
+
+                        break
+
+                    time.sleep(0.2)
+
 
 
                 if not vnc_ready:
@@ -587,6 +915,12 @@ chmod 666 /tmp/x11vnc_$RFBPORT.log 2>/dev/null || true
     return {"success": False, "message": "Falha desconhecida ao iniciar VNC."}
 
 
+# Tamanho máximo de cada recv_into ao ler um frame RFB bruto (um frame 1080p tem ~8 MB)
+
+_RFB_RECV_CHUNK = 1 << 20
+
+
+
 def _try_vnc_rfb_frame(ip: str, port: int = 5900, timeout: float = 1.5) -> Optional[bytes]:
 
     """Conecta diretamente no servidor RFB (VNC) se a porta estiver aberta e captura 1 frame como JPEG."""
@@ -601,6 +935,10 @@ def _try_vnc_rfb_frame(ip: str, port: int = 5900, timeout: float = 1.5) -> Optio
 
         s = socket.create_connection((ip, port), timeout=timeout)
 
+        # Handshake RFB em mensagens pequenas de ida e volta: sem Nagle, nenhuma espera por ACK atrasado
+
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
         server_ver = s.recv(12)
 
         if not server_ver.startswith(b'RFB '):
@@ -703,21 +1041,31 @@ def _try_vnc_rfb_frame(ip: str, port: int = 5900, timeout: float = 1.5) -> Optio
 
             expected_bytes = rw * rh * 4
 
-            buf = bytearray()
+            # Buffer do frame inteiro alocado de uma vez e preenchido com recv_into em blocos de 1 MiB:
+
+            # sem um bytes novo por recv nem realocações do bytearray a cada extend
+
+            buf = bytearray(expected_bytes)
+
+            view = memoryview(buf)
+
+            received = 0
 
-            while len(buf) < expected_bytes:
+            while received < expected_bytes:
 
-                chunk = s.recv(min(65536, expected_bytes - len(buf)))
+                n = s.recv_into(view[received:], min(_RFB_RECV_CHUNK, expected_bytes - received))
 
-                if not chunk:
+                if not n:
 
                     break
 
-                buf.extend(chunk)
+                received += n
+
+            view.release()
 
             s.close()
 
-            if len(buf) == expected_bytes:
+            if received == expected_bytes:
 
                 from PIL import Image
 
@@ -815,19 +1163,15 @@ def get_remote_screenshot(ip: str, username: str, password: str, logger: logging
 
             t_str = str(target_display).strip()
 
+            seat_disp = None if t_str.startswith(':') else _seat_alias_display(t_str, displays)
+
             if t_str.startswith(':'):
 
                 disp = t_str
 
-            elif 'seat1' in t_str.lower() or 'aluno2' in t_str.lower() or t_str == '1':
-
-                disp = displays[1] if len(displays) > 1 else ":1"
-
-                target_user = t_str
-
-            elif 'seat0' in t_str.lower() or 'aluno1' in t_str.lower() or t_str == '0':
+            elif seat_disp:
 
-                disp = displays[0] if len(displays) > 0 else ":0"
+                disp = seat_disp
 
                 target_user = t_str
 
@@ -1101,12 +1445,12 @@ exit 1
 
         b64_script = base64.b64encode(script_body.encode('utf-8')).decode('utf-8')
 
-        capture_cmd = f"echo {shlex.quote(password)} | sudo -S -p '' bash -c 'echo {b64_script} | base64 -d | bash'"
-
-        capture_cmd = capture_cmd.replace('\r', '')
+        capture_cmd = f"sudo -S -p '' bash -c 'echo {b64_script} | base64 -d | bash'"
 
         stdin, stdout, stderr = ssh.exec_command(capture_cmd, get_pty=False, timeout=8)
 
+        _send_sudo_password(stdin, password)
+
         image_bytes = stdout.read()
 
 